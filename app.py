@@ -4,14 +4,29 @@ Flask Web App - GUI för YouTube-hantering och manuell trigger
 
 from flask import Flask, render_template, request, jsonify, redirect, url_for
 import os
+import sys
+import atexit
+import signal
 import threading
 import requests
 from datetime import datetime
 from services.supabase_service import SupabaseService
+from services.drive_service import create_renderer
 
 app = Flask(__name__)
 supabase = SupabaseService()
 
+# PDF-renderare som lever lika länge som web-appen - slipper kallstarta Chromium varje körning
+render_worker = create_renderer()
+atexit.register(render_worker.close)
+
+def warm_render_worker():
+    try:
+        render_worker.warm()
+        print("✓ PDF-renderare startad", flush=True)
+    except Exception as e:
+        print(f"Kunde inte starta PDF-renderare: {e}", flush=True)
+
 # Global status för körning
 run_status = {
     'running': False,
@@ -49,6 +64,12 @@ def health():
     except Exception as e:
         health_status['supabase_ping'] = f'error: {str(e)}'
     
+    # Kolla PDF-renderaren (startas om automatiskt om browsern dött)
+    try:
+        health_status['renderer'] = render_worker.health()
+    except Exception as e:
+        health_status['renderer'] = {'status': f'error: {str(e)}'}
+    
     return jsonify(health_status)
 
 @app.route('/')
@@ -133,7 +154,7 @@ def run_summary():
             sys.path.insert(0, os.path.dirname(__file__))
             from main import main as main_func
             
-            main_func()
+            main_func(renderer=render_worker)
             
             print("=== Main completed successfully ===", flush=True)
             run_status['running'] = False
@@ -152,6 +173,16 @@ def run_summary():
     
     return jsonify({'success': True, 'message': 'Körning startad'})
 
+@app.route('/api/sync', methods=['POST'])
+def sync_gmail():
+    """Inkrementell Gmail-synk - kan köras dagligen så att fredagskörningen blir billig"""
+    try:
+        from services.gmail_service import GmailService
+        added = GmailService().sync()
+        return jsonify({'success': True, 'added': added})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/api/status')
 def get_status():
     """Hämta körningsstatus"""
@@ -166,5 +197,9 @@ def view_summary(week):
     return render_template('summary.html', summary=summary)
 
 if __name__ == '__main__':
+    # SIGTERM (t.ex. vid redeploy) ska gå via atexit så att Chromium stängs snyggt
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    threading.Thread(target=warm_render_worker, daemon=True).start()
+    
     port = int(os.getenv('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
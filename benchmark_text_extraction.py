@@ -0,0 +1,87 @@
+"""
+Benchmark för textextraktion ur newsletter-HTML
+Mäter hastighet och hur mycket text (tokens) som skickas till Claude per newsletter
+
+Korpus: en mapp med .html-filer. Hämta förra veckans newsletters från Gmail med
+    python benchmark_text_extraction.py --fetch newsletter_corpus
+och kör sedan benchmarken med
+    python benchmark_text_extraction.py newsletter_corpus
+"""
+
+import os
+import sys
+import time
+
+from utils.html_text import extract_newsletter_text, html_to_markdown
+from utils.prompt_packer import estimate_tokens
+
+
+def fetch_corpus(corpus_dir):
+    """Spara HTML för förra veckans newsletters som filer i corpus_dir"""
+    from services.gmail_service import GmailService
+
+    os.makedirs(corpus_dir, exist_ok=True)
+    gmail = GmailService()
+    newsletters = list(gmail.iter_newsletters())
+    bodies = gmail.get_html_bodies([nl['id'] for nl in newsletters])
+
+    for msg_id, html_body in bodies.items():
+        with open(os.path.join(corpus_dir, f'{msg_id}.html'), 'w', encoding='utf-8') as f:
+            f.write(html_body)
+
+    print(f"✅ Sparade {len(bodies)} newsletters i {corpus_dir}")
+
+
+def run_benchmark(corpus_dir, rounds=5):
+    """Jämför ren Markdown-konvertering med rensad extraktion"""
+    files = sorted(f for f in os.listdir(corpus_dir) if f.endswith(('.html', '.htm')))
+    if not files:
+        print(f"❌ Inga .html-filer i {corpus_dir}")
+        return
+
+    documents = []
+    for name in files:
+        with open(os.path.join(corpus_dir, name), encoding='utf-8', errors='replace') as f:
+            documents.append((name, f.read()))
+
+    totals = {'html': 0, 'markdown': 0, 'text': 0, 'seconds': 0.0}
+    print(f"{'Fil':<40} {'HTML kB':>8} {'MD tok':>8} {'Text tok':>9} {'ms':>7}")
+    for name, html_body in documents:
+        markdown = html_to_markdown(html_body)
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            text = extract_newsletter_text(html_body)
+        seconds = (time.perf_counter() - start) / rounds
+
+        markdown_tokens = estimate_tokens(markdown)
+        text_tokens = estimate_tokens(text)
+        totals['html'] += len(html_body)
+        totals['markdown'] += markdown_tokens
+        totals['text'] += text_tokens
+        totals['seconds'] += seconds
+        print(f"{name[:40]:<40} {len(html_body) / 1024:>8.1f} {markdown_tokens:>8} {text_tokens:>9} {seconds * 1000:>7.1f}")
+
+    saved = 1 - totals['text'] / totals['markdown'] if totals['markdown'] else 0
+    print(f"\n{len(documents)} newsletters, {totals['html'] / 1024 / 1024:.1f} MB HTML")
+    print(f"Markdown: ~{totals['markdown']} tokens, rensad text: ~{totals['text']} tokens ({saved:.0%} mindre)")
+    print(f"Extraktion: {totals['seconds'] * 1000 / len(documents):.1f} ms per newsletter, "
+          f"{totals['html'] / 1024 / 1024 / totals['seconds']:.1f} MB/s")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Användning: python benchmark_text_extraction.py [--fetch] <korpus_mapp>")
+        print("Exempel: python benchmark_text_extraction.py --fetch newsletter_corpus")
+        sys.exit(1)
+
+    if sys.argv[1] == '--fetch':
+        if len(sys.argv) < 3:
+            print("❌ Ange mappen som korpusen ska sparas i")
+            sys.exit(1)
+        fetch_corpus(sys.argv[2])
+    else:
+        if not os.path.isdir(sys.argv[1]):
+            print(f"❌ Mappen {sys.argv[1]} hittas inte")
+            sys.exit(1)
+        run_benchmark(sys.argv[1])
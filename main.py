@@ -4,7 +4,10 @@ Körs varje fredag kl 08:00 via Railway Cron
 """
 
 import os
+import re
 import sys
+from concurrent.futures import ThreadPoolExecutor, wait
+from itertools import islice
 from datetime import datetime, timedelta
 from pathlib import Path
 
@@ -14,12 +17,33 @@ from services.youtube_service import YouTubeService
 from services.claude_service import ClaudeService
 from services.supabase_service import SupabaseService
 from services.email_service import EmailService
+from utils.dedup import merge_near_duplicates
 from utils.logger import setup_logger
 
 logger = setup_logger()
 
-def main():
-    """Huvudflöde för veckosammanfattning"""
+def chunked(iterable, size):
+    """Dela upp en (lat) iterator i listor om högst size element"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def remove_links(markdown, urls):
+    """Ta bort länkar till urls ur Markdown - länktexten behålls"""
+    for url in urls:
+        escaped = re.escape(url)
+        markdown = re.sub(rf'\[([^\]]*)\]\({escaped}\)', r'\1', markdown)
+        markdown = re.sub(rf'[ \t]*\(?{escaped}\)?', '', markdown)
+    return markdown
+
+def main(renderer=None):
+    """Huvudflöde för veckosammanfattning
+    
+    renderer: valfri delad PdfRenderer (web-appen håller en varm browser mellan körningar)
+    """
     try:
         print("DEBUG: main() started", flush=True)
         logger.info("=== Startar veckosammanfattning ===")
@@ -28,7 +52,7 @@ def main():
         print("DEBUG: Initializing services", flush=True)
         gmail = GmailService()
         print("DEBUG: Gmail service OK", flush=True)
-        drive = DriveService()
+        drive = DriveService(renderer=renderer)
         print("DEBUG: Drive service OK", flush=True)
         youtube = YouTubeService()
         print("DEBUG: YouTube service OK", flush=True)
@@ -39,48 +63,134 @@ def main():
         email_service = EmailService()
         print("DEBUG: Email service OK", flush=True)
         
-        # 1. Hämta newsletters från senaste veckan
-        logger.info("Hämtar newsletters från Gmail...")
-        print("DEBUG: Fetching newsletters", flush=True)
-        newsletters = gmail.get_newsletters_last_week()
-        logger.info(f"Hittade {len(newsletters)} newsletters")
-        
-        if not newsletters:
-            logger.warning("Inga newsletters hittades - avslutar")
-            return
-        
-        # 2. Skapa veckomapp på Drive
+        # 1-3. Hämta newsletters från senaste veckan och spara dem till Drive allt eftersom
+        # de kommer in, en grupp i taget så att bara gruppens HTML hålls i minnet
         week_number = datetime.now().isocalendar()[1]
         year = datetime.now().year
         folder_name = f"{year}-W{week_number:02d}"
-        logger.info(f"Skapar mapp på Drive: {folder_name}")
-        folder_id = drive.create_weekly_folder(folder_name)
+        folder_id = None
+        
+        logger.info("Hämtar newsletters från Gmail och sparar till Drive...")
+        print("DEBUG: Fetching newsletters", flush=True)
+        # Inkrementellt läge: hämta bara det som tillkommit sedan senaste synk
+        incremental = os.getenv('GMAIL_SYNC_MODE', 'query') == 'incremental'
+        if incremental:
+            gmail.sync()
+            newsletter_iter = gmail.iter_pending_newsletters()
+        else:
+            newsletter_iter = gmail.iter_newsletters()
+        
+        # Drive-arbetet (rendering + uppladdning) körs i bakgrunden. Fil-ID:n reserveras
+        # i förväg så att länkarna är kända direkt och Claude kan starta innan Drive är klart.
+        drive_executor = ThreadPoolExecutor(max_workers=1)
+        drive_jobs = []
         
-        # 3. Spara newsletters till Drive
-        logger.info("Sparar newsletters till Drive...")
+        newsletter_ids = []
         saved_newsletters = []
-        for newsletter in newsletters:
+        for chunk in chunked(newsletter_iter, drive.renderer.concurrency * 2):
+            newsletter_ids.extend(nl['id'] for nl in chunk)
+            
+            # Skapa veckomappen först när vi vet att det finns något att spara
+            if folder_id is None:
+                logger.info(f"Skapar mapp på Drive: {folder_name}")
+                folder_id = drive.create_weekly_folder(folder_name)
+            
             try:
-                file_info = drive.save_newsletter(newsletter, folder_id)
+                # HTML-body hämtas först här och behövs inte efter Drive-steget,
+                # medan den utdragna brödtexten följer med till Claude
+                bodies = gmail.get_bodies([nl['id'] for nl in chunk])
+                chunk_with_bodies = [{**nl, 'html_body': bodies.get(nl['id'], ("", ""))[0]} for nl in chunk]
+                plans = drive.plan_files(chunk_with_bodies, folder_id)
+            except Exception as e:
+                logger.error(f"Kunde inte förbereda newsletters för Drive: {e}")
+                continue
+            
+            # Begränsa hur mycket HTML som väntar på Drive samtidigt
+            pending_jobs = [job for job in drive_jobs if not job[2].done()]
+            if len(pending_jobs) >= 2:
+                wait([pending_jobs[0][2]])
+            
+            future = drive_executor.submit(drive.save_newsletters, chunk_with_bodies, folder_id, plans=plans)
+            drive_jobs.append((chunk, plans, future))
+            
+            for newsletter, plan in zip(chunk, plans):
                 saved_newsletters.append({
                     **newsletter,
-                    'drive_url': file_info['url'],
-                    'drive_id': file_info['id']
+                    'text': bodies.get(newsletter['id'], ("", ""))[1],
+                    'drive_url': plan['url'],
+                    'drive_id': plan['id']
                 })
-            except Exception as e:
-                logger.error(f"Kunde inte spara newsletter: {e}")
-                continue
         
-        logger.info(f"Sparade {len(saved_newsletters)} newsletters till Drive")
+        logger.info(f"Hittade {len(newsletter_ids)} newsletters")
+        
+        if not newsletter_ids:
+            drive_executor.shutdown()
+            logger.warning("Inga newsletters hittades - avslutar")
+            return
         
         # 4. Hämta YouTube-lista
         logger.info("Hämtar YouTube-lista...")
         youtube_videos = youtube.get_videos()
         logger.info(f"Hämtade {len(youtube_videos)} YouTube-videos")
         
-        # 5. AI-analys med Claude
+        # 5. AI-analys med Claude - nästan identiska newsletters och upprepade nyheter skickas bara en gång
+        claude_newsletters = saved_newsletters
+        dedup_threshold = float(os.getenv('DEDUP_THRESHOLD', '0.5'))
+        if dedup_threshold < 1:
+            claude_newsletters, dedup_stats = merge_near_duplicates(saved_newsletters, dedup_threshold)
+            logger.info(
+                f"Dubblettsökning: {dedup_stats['newsletters']} newsletters → {dedup_stats['clusters']} unika, "
+                f"{dedup_stats['removed_stories']} upprepade stycken borttagna"
+            )
+        
         logger.info("Analyserar med Claude...")
-        analysis = claude.analyze_week(saved_newsletters, youtube_videos, week_number)
+        analysis = claude.analyze_week(claude_newsletters, youtube_videos, week_number)
+        metrics = claude.api.metrics()
+        logger.info(
+            f"Claude: {metrics['succeeded']} anrop, {metrics['retries']} omförsök "
+            f"({metrics['rate_limited']} rate limit), {metrics['input_tokens']} in / {metrics['output_tokens']} ut, "
+            f"{metrics['throttle_seconds']}s strypt, max {metrics['max_in_flight']} samtidiga"
+        )
+        
+        # Vänta in Drive innan länkarna sparas och skickas ut
+        logger.info("Väntar på att Drive-uppladdningen ska bli klar...")
+        saved_count = 0
+        failed = []
+        for chunk, plans, future in drive_jobs:
+            try:
+                file_infos = future.result()
+            except Exception as e:
+                logger.error(f"Kunde inte spara newsletters: {e}")
+                file_infos = [None] * len(chunk)
+            for newsletter, plan, file_info in zip(chunk, plans, file_infos):
+                if file_info:
+                    saved_count += 1
+                else:
+                    logger.error(f"Kunde inte spara newsletter: {newsletter['subject']}")
+                    failed.append((newsletter, plan))
+        drive_executor.shutdown()
+        
+        # Länkarna är redan utdelade till Claude - lägg en platshållare under det reserverade
+        # ID:t, och ta bort länken helt om inte ens det går
+        missing_urls = set()
+        for newsletter, plan in failed:
+            try:
+                drive.save_placeholder(newsletter, folder_id, plan['id'])
+            except Exception as e:
+                logger.error(f"Kunde inte spara platshållare för {newsletter['subject']}: {e}")
+                missing_urls.add(plan['url'])
+        if missing_urls:
+            logger.warning(f"{len(missing_urls)} Drive-länkar saknar fil - tas bort ur sammanfattningen")
+            analysis['markdown'] = remove_links(analysis['markdown'], missing_urls)
+            saved_newsletters = [nl for nl in saved_newsletters if nl['drive_url'] not in missing_urls]
+        
+        if drive.optimize_pdfs and drive.pdf_bytes_before:
+            logger.info(
+                f"PDF-optimering: {drive.pdf_bytes_before / 1024 / 1024:.1f} MB → "
+                f"{drive.pdf_bytes_after / 1024 / 1024:.1f} MB"
+            )
+        drive.close()
+        logger.info(f"Sparade {saved_count} newsletters till Drive")
         
         # 6. Spara till Supabase
         logger.info("Sparar till Supabase...")
@@ -110,8 +220,11 @@ def main():
         
         # 8. Markera newsletters som lästa
         logger.info("Markerar newsletters som lästa...")
-        newsletter_ids = [nl['id'] for nl in newsletters]
-        gmail.mark_as_read(newsletter_ids)
+        unread_ids = set(gmail.mark_as_read(newsletter_ids))
+        if unread_ids:
+            logger.warning(f"{len(unread_ids)} newsletters kunde inte markeras som lästa")
+        if incremental:
+            gmail.clear_pending([i for i in newsletter_ids if i not in unread_ids])
         
         logger.info("=== Klart! ===")
         logger.info(f"Sammanfattning sparad med ID: {summary_id}")
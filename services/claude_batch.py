@@ -0,0 +1,172 @@
+"""Message Batches - asynkrona Claude-anrop för per-newsletter-extraktion
+
+Extraktionen per newsletter behöver inte vara interaktiv. Alla anrop skickas
+som ett Message Batch-jobb (lägre pris per token) och jobbet pollas tills det
+är klart. Jobbets ID sparas i en lokal state-fil, så en avbruten körning kan
+återuppta samma jobb istället för att skicka in allt igen.
+
+LocalMessageBatches har samma gränssnitt som batch-endpointen men kör anropen
+lokalt i en bakgrundstråd - för att testa flödet utan att vänta på API:t.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+
+class MessageBatchJob:
+    def __init__(self, batches, state_file='claude_batch_state.json', poll_interval=30, max_wait=3600):
+        self.batches = batches
+        self.state_file = state_file
+        self.poll_interval = poll_interval
+        self.max_wait = max_wait
+
+    def run(self, requests):
+        """Kör {custom_id: params} som ett batch-jobb - returnerar {custom_id: svarstext}
+
+        Anrop som misslyckades, avbröts eller löpte ut saknas i resultatet.
+        Kastar TimeoutError om jobbet inte blivit klart inom max_wait.
+        """
+        if not requests:
+            return {}
+
+        batch_id = self._submit_or_resume(requests)
+        self._wait(batch_id)
+
+        texts = {}
+        failed = 0
+        for entry in self.batches.results(batch_id):
+            if entry.result.type == 'succeeded':
+                texts[entry.custom_id] = entry.result.message.content[0].text
+            else:
+                failed += 1
+
+        print(f"✓ Batch {batch_id}: {len(texts)} klara, {failed} misslyckade")
+        self._save_state({})
+        return texts
+
+    def _submit_or_resume(self, requests):
+        """Återuppta sparat jobb för exakt samma anrop, annars skicka in ett nytt"""
+        key = _requests_key(requests)
+        state = self._load_state()
+        if state.get('key') == key:
+            try:
+                self.batches.retrieve(state['batch_id'])
+                print(f"Återupptar batch {state['batch_id']} (skapad {state['created']})")
+                return state['batch_id']
+            except Exception as e:
+                print(f"Sparad batch {state['batch_id']} kan inte återupptas: {e}")
+
+        if state.get('batch_id'):
+            # Gammalt jobb för andra anrop - behövs inte längre
+            try:
+                self.batches.cancel(state['batch_id'])
+            except Exception as e:
+                print(f"Kunde inte avbryta gammal batch {state['batch_id']}: {e}")
+
+        batch = self.batches.create(requests=[
+            {'custom_id': custom_id, 'params': params} for custom_id, params in requests.items()
+        ])
+        self._save_state({'batch_id': batch.id, 'key': key, 'created': datetime.now().isoformat()})
+        print(f"Batch {batch.id} skapad med {len(requests)} anrop")
+        return batch.id
+
+    def _wait(self, batch_id):
+        """Polla tills jobbet är klart - returnerar det avslutade jobbet"""
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            batch = self.batches.retrieve(batch_id)
+            if batch.processing_status == 'ended':
+                return batch
+
+            counts = batch.request_counts
+            if time.monotonic() + self.poll_interval > deadline:
+                raise TimeoutError(
+                    f"Batch {batch_id} inte klar efter {self.max_wait}s ({counts.processing} kvar) - "
+                    f"state sparad, nästa körning återupptar jobbet"
+                )
+            print(f"Batch {batch_id}: {counts.processing} kvar, {counts.succeeded} klara")
+            time.sleep(self.poll_interval)
+
+    def _load_state(self):
+        """Läs batch-state från lokal fil"""
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            print(f"Kunde inte läsa batch-state: {e}")
+            return {}
+
+    def _save_state(self, state):
+        """Spara batch-state atomiskt till lokal fil"""
+        tmp_path = f"{self.state_file}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_file)
+
+
+class LocalMessageBatches:
+    """Lokal ersättning för batch-endpointen - create_message(params) ger svarstexten"""
+
+    def __init__(self, create_message):
+        self.create_message = create_message
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def create(self, requests):
+        batch_id = f"local_{int(time.time() * 1000)}"
+        job = {'requests': list(requests), 'results': [], 'status': 'in_progress'}
+        with self.lock:
+            self.jobs[batch_id] = job
+        threading.Thread(target=self._process, args=(job,), name=f'batch-{batch_id}', daemon=True).start()
+        return self.retrieve(batch_id)
+
+    def retrieve(self, batch_id):
+        with self.lock:
+            job = self.jobs[batch_id]
+            succeeded = sum(1 for entry in job['results'] if entry.result.type == 'succeeded')
+            counts = SimpleNamespace(
+                processing=len(job['requests']) - len(job['results']),
+                succeeded=succeeded,
+                errored=len(job['results']) - succeeded,
+                canceled=0,
+                expired=0
+            )
+            return SimpleNamespace(id=batch_id, processing_status=job['status'], request_counts=counts)
+
+    def results(self, batch_id):
+        with self.lock:
+            return list(self.jobs[batch_id]['results'])
+
+    def cancel(self, batch_id):
+        with self.lock:
+            if batch_id in self.jobs:
+                self.jobs[batch_id]['status'] = 'ended'
+
+    def _process(self, job):
+        for request in job['requests']:
+            if job['status'] == 'ended':
+                break
+            try:
+                text = self.create_message(request['params'])
+                result = SimpleNamespace(
+                    type='succeeded',
+                    message=SimpleNamespace(content=[SimpleNamespace(type='text', text=text)])
+                )
+            except Exception as e:
+                result = SimpleNamespace(type='errored', error=str(e))
+            with self.lock:
+                job['results'].append(SimpleNamespace(custom_id=request['custom_id'], result=result))
+        with self.lock:
+            job['status'] = 'ended'
+
+
+def _requests_key(requests):
+    payload = json.dumps(requests, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
@@ -0,0 +1,218 @@
+"""Claude-klient med rate limiting, omförsök och deadlines
+
+Lindar in Anthropic-klienten så att parallella anrop (map-fasen, strukturerat
+läge) kan köras så snabbt som möjligt utan att slå i leverantörens gränser:
+
+- token buckets för anrop, input-tokens och output-tokens per minut
+- max antal samtidiga anrop
+- omförsök med exponentiell backoff och jitter vid 429/529/5xx och nätverksfel,
+  där retry-after från API:t respekteras och pausar alla anrop
+- en total deadline per anrop, inklusive väntan och omförsök
+"""
+
+import random
+import threading
+import time
+from anthropic import APIConnectionError, APIStatusError
+
+from utils.prompt_packer import estimate_tokens
+from utils.rate_limit import TokenBucket
+
+# Statuskoder som är värda att försöka igen (529 = overloaded)
+RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+
+class ClaudeClient:
+    def __init__(self, client, requests_per_minute=50, input_tokens_per_minute=30000,
+                 output_tokens_per_minute=8000, max_concurrency=4, max_retries=5, timeout=120, deadline=360):
+        self.client = client
+        self.requests = TokenBucket(requests_per_minute)
+        self.input_tokens = TokenBucket(input_tokens_per_minute)
+        self.output_tokens = TokenBucket(output_tokens_per_minute)
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.deadline = deadline
+        # Satt efter en 429 med retry-after - gäller alla anrop, inte bara det som fick felet
+        self.pause_until = 0.0
+        self.lock = threading.Lock()
+        self.stats = {
+            'requests': 0,
+            'succeeded': 0,
+            'failed': 0,
+            'retries': 0,
+            'rate_limited': 0,
+            'throttle_seconds': 0.0,
+            'backoff_seconds': 0.0,
+            'input_tokens': 0,
+            'output_tokens': 0,
+            'in_flight': 0,
+            'max_in_flight': 0
+        }
+
+    def create(self, deadline=None, **kwargs):
+        """messages.create med rate limiting och omförsök
+
+        deadline: max antal sekunder för hela anropet inklusive väntan och
+        omförsök (standard self.deadline). Kastar sista felet, eller
+        TimeoutError om deadline passeras innan ett svar kommit.
+        """
+        try:
+            return self._create_with_retries(deadline or self.deadline, kwargs)
+        except Exception:
+            self._count('failed', 1)
+            raise
+
+    def metrics(self):
+        """Ögonblicksbild av räknarna"""
+        with self.lock:
+            metrics = dict(self.stats)
+        metrics['throttle_seconds'] = round(metrics['throttle_seconds'], 1)
+        metrics['backoff_seconds'] = round(metrics['backoff_seconds'], 1)
+        return metrics
+
+    def _create_with_retries(self, deadline, kwargs):
+        end = time.monotonic() + deadline
+        estimated_input = _estimate_input_tokens(kwargs)
+        self._check_limits(estimated_input, kwargs.get('max_tokens', 0))
+        last_error = None
+
+        for attempt in range(self.max_retries + 1):
+            self._wait_for_pause(end)
+            throttled = self.requests.acquire(1, deadline=end)
+            throttled += self.input_tokens.acquire(estimated_input, deadline=end)
+            # Output är okänt i förväg - vänta bara tills hinken inte är i minus
+            throttled += self.output_tokens.acquire(1, deadline=end)
+            self._count('throttle_seconds', throttled)
+
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                # Inget anrop gjordes - lämna tillbaka reservationen
+                self.input_tokens.adjust(estimated_input)
+                break
+
+            try:
+                response = self._send(kwargs, timeout=min(self.timeout, remaining))
+            except (APIStatusError, APIConnectionError) as e:
+                last_error = e
+                # Hinkarna fick inga tokens använda - lämna tillbaka reservationen
+                self.input_tokens.adjust(estimated_input)
+                if not self._should_retry(e) or attempt == self.max_retries:
+                    break
+
+                delay = self._retry_delay(e, attempt)
+                remaining = end - time.monotonic()
+                # retry-after som passerar deadline är lönlöst att vänta på, men
+                # en slumpad backoff kortas hellre än att ge upp i förtid
+                if remaining <= 0 or (_retry_after(e) is not None and delay >= remaining):
+                    break
+                delay = min(delay, remaining)
+                print(f"Claude-anrop misslyckades ({_describe(e)}) - nytt försök om {delay:.1f}s")
+                self._count('retries', 1)
+                self._count('backoff_seconds', delay)
+                time.sleep(delay)
+                continue
+
+            usage = response.usage
+            # Rätta reservationen mot verklig förbrukning
+            self.input_tokens.adjust(estimated_input - usage.input_tokens)
+            self.output_tokens.adjust(-usage.output_tokens)
+            self._count('succeeded', 1)
+            self._count('input_tokens', usage.input_tokens)
+            self._count('output_tokens', usage.output_tokens)
+            return response
+
+        if last_error is not None:
+            raise last_error
+        raise TimeoutError(f"Claude-anropet hann inte klart inom {deadline:.0f}s")
+
+    def _check_limits(self, estimated_input, max_tokens):
+        """Varna för anrop som är större än en hel minuts kvot
+
+        Hinkarna släpper igenom sådana anrop när de är fulla, men API:t kommer
+        troligen att svara med 429 oavsett hur länge vi väntar.
+        """
+        if self.input_tokens.enabled and estimated_input > self.input_tokens.capacity:
+            print(
+                f"Varning: anropet är ~{estimated_input} input-tokens, mer än gränsen "
+                f"{self.input_tokens.capacity} per minut"
+            )
+        if self.output_tokens.enabled and max_tokens > self.output_tokens.capacity:
+            print(
+                f"Varning: max_tokens {max_tokens} är mer än gränsen "
+                f"{self.output_tokens.capacity} output-tokens per minut"
+            )
+
+    def _send(self, kwargs, timeout):
+        with self.semaphore:
+            with self.lock:
+                self.stats['requests'] += 1
+                self.stats['in_flight'] += 1
+                self.stats['max_in_flight'] = max(self.stats['max_in_flight'], self.stats['in_flight'])
+            try:
+                return self.client.messages.create(timeout=timeout, **kwargs)
+            finally:
+                self._count('in_flight', -1)
+
+    def _should_retry(self, error):
+        if isinstance(error, APIStatusError):
+            return error.status_code in RETRY_STATUS_CODES
+        # Nätverksfel och timeouts
+        return True
+
+    def _retry_delay(self, error, attempt):
+        """retry-after från API:t om det finns, annars exponentiell backoff med full jitter"""
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            if error.status_code == 429:
+                self._count('rate_limited', 1)
+                with self.lock:
+                    self.pause_until = max(self.pause_until, time.monotonic() + retry_after)
+            return retry_after + random.uniform(0, 1)
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+    def _wait_for_pause(self, end):
+        wait = self.pause_until - time.monotonic()
+        if wait <= 0:
+            return
+        if time.monotonic() + wait > end:
+            raise TimeoutError(f"Rate limit: pausen på {wait:.1f}s skulle passera deadline")
+        self._count('throttle_seconds', wait)
+        time.sleep(wait)
+
+    def _count(self, name, amount):
+        with self.lock:
+            self.stats[name] += amount
+
+
+def _retry_after(error):
+    """Sekunder enligt retry-after-headers, eller None"""
+    if not isinstance(error, APIStatusError):
+        return None
+    headers = error.response.headers
+    for header, scale in (('retry-after-ms', 1000), ('retry-after', 1)):
+        try:
+            return max(0.0, float(headers[header]) / scale)
+        except (KeyError, TypeError, ValueError):
+            continue
+    return None
+
+
+def _describe(error):
+    if isinstance(error, APIStatusError):
+        return f"HTTP {error.status_code}"
+    return type(error).__name__
+
+
+def _estimate_input_tokens(kwargs):
+    """Uppskatta input-tokens från system-prompt och meddelanden"""
+    texts = []
+    for part in [kwargs.get('system')] + [message.get('content') for message in kwargs.get('messages', [])]:
+        if isinstance(part, str):
+            texts.append(part)
+        elif isinstance(part, list):
+            texts.extend(block.get('text', '') for block in part if isinstance(block, dict))
+    return sum(estimate_tokens(text) for text in texts)
@@ -1,194 +1,47 @@
 """Claude AI Service - Analyserar och sammanfattar veckan"""
 
 import os
-import random
-from datetime import datetime, timedelta
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from anthropic import Anthropic
 
-class ClaudeService:
-    def __init__(self):
-        self.client = Anthropic(api_key=os.getenv('CLAUDE_API_KEY'))
-        self.model = "claude-sonnet-4-20250514"
-    
-    def _calculate_video_weight(self, published_date):
-        """Beräkna sannolikhet baserat på ålder"""
-        if not published_date:
-            return 0.3  # Default medel-sannolikhet om datum saknas
-        
-        try:
-            if isinstance(published_date, str):
-                pub_date = datetime.strptime(published_date, '%Y-%m-%d').date()
-            else:
-                pub_date = published_date
-            
-            today = datetime.now().date()
-            days_old = (today - pub_date).days
-            
-            # Viktning baserat på ålder
-            if days_old < 30:  # <1 månad
-                return 0.8
-            elif days_old < 90:  # 1-3 månader
-                return 0.5
-            elif days_old < 180:  # 3-6 månader
-                return 0.3
-            else:  # >6 månader
-                return 0.1
-        except:
-            return 0.3
-    
-    def _weighted_video_selection(self, videos, count=3):
-        """Välj videos med viktad slumpmässighet"""
-        if not videos:
-            return []
-        
-        # Beräkna vikter för alla videos
-        weighted_videos = []
-        for video in videos:
-            weight = self._calculate_video_weight(video.get('published_date'))
-            weighted_videos.append((video, weight))
-        
-        # Slumpmässigt urval baserat på vikter
-        selected = []
-        remaining = weighted_videos.copy()
-        
-        for _ in range(min(count, len(videos))):
-            if not remaining:
-                break
-            
-            # Weighted random choice
-            total_weight = sum(w for _, w in remaining)
-            if total_weight == 0:
-                # Fallback om alla har vikt 0
-                video, _ = random.choice(remaining)
-            else:
-                rand = random.uniform(0, total_weight)
-                cumsum = 0
-                video = None
-                for v, w in remaining:
-                    cumsum += w
-                    if rand <= cumsum:
-                        video = v
-                        break
-                
-                if video is None:
-                    video = remaining[0][0]
-            
-            selected.append(video)
-            remaining = [(v, w) for v, w in remaining if v != video]
-        
-        return selected
-    
-    def analyze_week(self, newsletters, youtube_videos, week_number):
-        """Analysera veckan och generera Markdown-sammanfattning + kort beskrivning"""
-        
-        # Gör viktad urval av YouTube-videos
-        selected_videos = self._weighted_video_selection(youtube_videos, count=10)
-        
-        # Bygg prompt med all data
-        prompt = self._build_analysis_prompt(newsletters, selected_videos, week_number)
-        
-        # Anropa Claude
-        response = self.client.messages.create(
-            model=self.model,
-            max_tokens=4000,
-            temperature=0.7,
-            messages=[
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ]
-        )
-        
-        markdown_content = response.content[0].text
-        
-        # Generera kort beskrivning för Teams-inlägg
-        short_description = self._generate_short_description(newsletters, selected_videos, week_number)
-        
-        # Extrahera YouTube-picks från resultatet (för databas)
-        youtube_picks = self._extract_youtube_picks(markdown_content)
-        
-        return {
-            'markdown': markdown_content,
-            'short_description': short_description,
-            'youtube_picks': youtube_picks
-        }
-    
-    def _generate_short_description(self, newsletters, videos, week_number):
-        """Generera kort beskrivning för Teams-inlägg"""
-        
-        # Ta top ämnen från newsletters
-        topics_prompt = f"""Baserat på dessa newsletters, skapa en kort punktlista med 4-5 nyckelhändelser denna vecka.
-
-NEWSLETTERS (ämnesrader):
-{chr(10).join([f"- {nl['subject']}" for nl in newsletters[:15]])}
+from services.claude_batch import LocalMessageBatches, MessageBatchJob
+from services.claude_client import ClaudeClient
 
-Skapa ENDAST en bullet-lista med 4-5 korta punkter (max 8 ord per punkt). Format:
-• Punkt 1
-• Punkt 2
-• Punkt 3
-etc.
-
-VIKTIGT: Bara bullets, ingen annan text."""
+from utils.prompt_packer import estimate_tokens, pack_blocks
+from utils.response_cache import ResponseCache, request_key
+from utils.video_selector import get_index as get_video_index
 
-        response = self.client.messages.create(
-            model=self.model,
-            max_tokens=200,
-            temperature=0.5,
-            messages=[{"role": "user", "content": topics_prompt}]
-        )
-        
-        bullets = response.content[0].text.strip()
-        
-        # Bygg kort meddelande
-        short_msg = f"""🤖 AI-veckans sammanfattning är uppdaterad (Vecka {week_number})
+# Blockmarkör i map-svaret, t.ex. "[3]"
+MAP_MARKER_RE = re.compile(r'^\[(\d+)\]$')
 
-Den här veckan:
-{bullets}
+# Sektioner i det strukturerade svaret
+STRUCTURED_SECTIONS = ('markdown', 'bullets', 'video_ids')
+BULLET_RE = re.compile(r'^\s*[•\-*]\s+(.+)$')
+# Länkmål i Markdown: [text](url)
+LINK_TARGET_RE = re.compile(r'\]\(\s*<?([^)\s>]+)>?\s*\)')
 
-⏱️ Lästid: ~5–6 min  
-👉 Full sammanfattning finns i fliken ovan"""
-        
-        return short_msg
-    
-    def _build_analysis_prompt(self, newsletters, youtube_videos, week_number):
-        """Bygg prompt för Claude"""
-        
-        # Skapa sammanfattning av newsletters (begränsa längd)
-        newsletters_summary = ""
-        for i, nl in enumerate(newsletters[:30], 1):  # Max 30 newsletters
-            # Använd snippet istället för full HTML för att spara tokens
-            newsletters_summary += f"\n## Newsletter {i}\n"
-            newsletters_summary += f"**Från:** {nl['from']}\n"
-            newsletters_summary += f"**Ämne:** {nl['subject']}\n"
-            newsletters_summary += f"**Drive-länk:** {nl['drive_url']}\n"
-            newsletters_summary += f"**Innehåll (kort):** {nl['snippet'][:300]}...\n"
-        
-        # Skapa lista av YouTube-videos
-        youtube_summary = ""
-        for i, video in enumerate(youtube_videos, 1):
-            youtube_summary += f"\n{i}. **{video['title']}**\n"
-            youtube_summary += f"   - URL: {video['url']}\n"
-            youtube_summary += f"   - Kategori: {video['category']}\n"
-            youtube_summary += f"   - Typ: {video['type']}\n"
-            youtube_summary += f"   - Beskrivning: {video['description']}\n"
-        
-        prompt = f"""Du är en AI-expert som skapar engagerande veckosammanfattningar om AI för arbetskollegor.
+# Tecken per newsletter som används för att matcha videos mot veckans innehåll
+VIDEO_QUERY_CHARS = 2000
 
-Din uppgift är att analysera dessa newsletters och YouTube-videos och skapa en veckosammanfattning i Markdown-format som ska postas på Teams.
+# Kortare prefix än så här cachas inte av API:t (Sonnet) - markeringen ignoreras då tyst
+PROMPT_CACHE_MIN_TOKENS = 1024
 
-# NEWSLETTERS FRÅN VECKAN
-{newsletters_summary}
+# Statiska instruktioner för veckosammanfattningen. De skickas som system-prompt
+# markerad för prompt caching, så att samma prefix inte bearbetas om vid varje anrop.
+# Prefix kortare än PROMPT_CACHE_MIN_TOKENS cachas inte - då loggas en varning.
+ANALYSIS_INSTRUCTIONS = """Du är en AI-expert som skapar engagerande veckosammanfattningar om AI för arbetskollegor.
 
-# TILLGÄNGLIGA YOUTUBE-VIDEOS
-{youtube_summary}
+Din uppgift är att analysera veckans newsletters och YouTube-videos (skickas i meddelandet) och skapa en veckosammanfattning i Markdown-format som ska postas på Teams.
 
 # SKAPA FÖLJANDE SAMMANFATTNING I MARKDOWN
 
 Skapa ett Teams-inlägg med denna struktur:
 
 ---
-# 🤖 AI-veckans sammanfattning - Vecka {week_number}
+# 🤖 AI-veckans sammanfattning - Vecka [veckonummer]
 
 ## ⚡ Veckans highlights
 [De 3 mest intressanta sakerna som hänt denna vecka - kort och kärnfullt]
@@ -219,7 +72,7 @@ VIKTIGT: Använd Markdown-format för länkar: [Länktext](URL), inte bara URL:e
 [En liten utmaning/uppgift för nyfikna kollegor att testa]
 
 ## 📚 Alla newsletters denna vecka
-Lista ALLA newsletters från listan ovan (inte bara Top 3). För varje:
+Lista ALLA newsletters från listan (inte bara Top 3). För varje:
 • **[Titel från ämnesraden]** - 🔗 [Läs här](Drive-länk)
 
 Format exempel (VIKTIGT: Tom rad mellan varje punkt för rätt formatering i Teams Loop):
@@ -230,7 +83,7 @@ Format exempel (VIKTIGT: Tom rad mellan varje punkt för rätt formatering i Tea
 • **ChatGPT får nya funktioner** - 🔗 [Läs här](https://drive.google.com/...)
 
 VIKTIGT: 
-1. Inkludera ALLA {len(newsletters)} newsletters från listan
+1. Inkludera ALLA newsletters från listan (antalet står i rubriken), även de under "Samma innehåll även i"
 2. Lägg till TOM RAD mellan varje punkt (två radbrytningar)
 3. Detta gör att listan renderas korrekt i Teams
 
@@ -246,14 +99,546 @@ VIKTIGT:
 - Fokusera på praktisk nytta
 - Länka alltid till originalinnehåll
 - Gör det lätt att scanna (tydliga rubriker)
-- Total längd: max 2 skärmlängder på mobil
+- Total längd: max 2 skärmlängder på mobil"""
+
+# Tillägg i strukturerat läge: sammanfattning, Teams-punkter och videoval i samma svar
+STRUCTURED_OUTPUT_INSTRUCTIONS = """# SVARSFORMAT
+
+Svara med EXAKT tre taggade sektioner och ingen annan text:
+
+<markdown>
+[Hela veckosammanfattningen i Markdown enligt strukturen ovan]
+</markdown>
+<bullets>
+• [4-5 korta punkter med veckans nyckelhändelser, max 8 ord per punkt]
+</bullets>
+<video_ids>
+[video-id för de 3 videos du valt under "Top 3 YouTube-klipp", kommaseparerade, t.ex. 12, 7, 31]
+</video_ids>"""
+
+def _uses_prompt_cache(kwargs):
+    """Om anropets system-prompt har ett block markerat för prompt caching"""
+    system = kwargs.get('system')
+    return isinstance(system, list) and any('cache_control' in block for block in system)
+
+def _source_count(newsletters):
+    """Antal källor, inklusive dubbletter som slagits ihop"""
+    return sum(1 + len(nl.get('duplicates', [])) for nl in newsletters)
+
+class ClaudeService:
+    def __init__(self):
+        # Timeout per anrop i sekunder - ett hängande anrop ska inte stoppa hela körningen
+        self.timeout = float(os.getenv('CLAUDE_TIMEOUT', '120'))
+        # Omförsök sköts av ClaudeClient (med rate limiting), inte av SDK:n
+        self.client = Anthropic(api_key=os.getenv('CLAUDE_API_KEY'), timeout=self.timeout, max_retries=0)
+        self.api = ClaudeClient(
+            self.client,
+            requests_per_minute=int(os.getenv('CLAUDE_RPM', '50')),
+            input_tokens_per_minute=int(os.getenv('CLAUDE_INPUT_TPM', '30000')),
+            output_tokens_per_minute=int(os.getenv('CLAUDE_OUTPUT_TPM', '8000')),
+            max_concurrency=int(os.getenv('CLAUDE_MAX_CONCURRENCY', '4')),
+            max_retries=int(os.getenv('CLAUDE_MAX_RETRIES', '5')),
+            timeout=self.timeout,
+            deadline=float(os.getenv('CLAUDE_CALL_DEADLINE', str(self.timeout * 3)))
+        )
+        self.model = "claude-sonnet-4-20250514"
+        
+        # Latens och tokens per anrop, för loggning
+        self.call_stats = []
+        
+        # Sammanfattningsläge: 'single', 'mapreduce', 'batch' (map-fasen som Message Batch)
+        # eller 'auto' (map-reduce vid fler än 30 newsletters)
+        self.summary_mode = os.getenv('CLAUDE_SUMMARY_MODE', 'auto')
+        self.map_group_size = int(os.getenv('CLAUDE_MAP_GROUP_SIZE', '5'))
+        self.map_concurrency = int(os.getenv('CLAUDE_MAP_CONCURRENCY', '4'))
+        self.map_chars_per_newsletter = int(os.getenv('CLAUDE_MAP_CHARS', '3000'))
+        
+        # Batch-läge: 'api' (Message Batches) eller 'local' (lokal ersättning för test)
+        self.batch_backend = os.getenv('CLAUDE_BATCH_BACKEND', 'api')
+        self.batch_state_file = os.getenv('CLAUDE_BATCH_STATE_FILE', 'claude_batch_state.json')
+        self.batch_poll_interval = float(os.getenv('CLAUDE_BATCH_POLL_SECONDS', '30'))
+        self.batch_max_wait = float(os.getenv('CLAUDE_BATCH_MAX_WAIT', '3600'))
+        
+        # 'structured': sammanfattning, Teams-punkter och videoval i ett anrop
+        # 'separate': två parallella anrop (används också som fallback)
+        self.output_mode = os.getenv('CLAUDE_OUTPUT_MODE', 'structured')
+        
+        # Seed för videourvalet - som standard veckonumret
+        self.video_seed = os.getenv('CLAUDE_VIDEO_SEED') or None
+        
+        # Lokal svarscache - en identisk omkörning ska inte kosta ett nytt anrop
+        cache_path = os.getenv('CLAUDE_CACHE_PATH', 'claude_cache.sqlite3')
+        cache_max_mb = int(os.getenv('CLAUDE_CACHE_MAX_MB', '50'))
+        cache_ttl_hours = float(os.getenv('CLAUDE_CACHE_TTL_HOURS', '168'))
+        self.cache = ResponseCache(cache_path, cache_max_mb * 1024 * 1024, cache_ttl_hours * 3600) if cache_path else None
+        
+        # Tokenbudget för indata - styr kostnad och latens istället för fasta antal
+        self.input_budget = int(os.getenv('CLAUDE_INPUT_BUDGET', '25000'))
+        self.short_input_budget = int(os.getenv('CLAUDE_SHORT_INPUT_BUDGET', '1500'))
+        # Ett anrop större än minutgränsen kan aldrig släppas igenom av API:t
+        input_limit = self.api.input_tokens.capacity
+        if self.api.input_tokens.enabled and self.input_budget > input_limit:
+            print(f"CLAUDE_INPUT_BUDGET ({self.input_budget}) är större än CLAUDE_INPUT_TPM - sänks till {input_limit}")
+            self.input_budget = input_limit
+    
+    def _select_videos(self, videos, newsletters, week_number, count=10):
+        """Välj videos som passar veckans innehåll, viktat på ålder och relevans
+        
+        Urvalet seedas med år och vecka, som veckomappen (t.ex. 2025-W07), eller
+        CLAUDE_VIDEO_SEED - en omkörning av samma vecka ger samma videos (och därmed
+        samma prompt), medan samma vecka ett annat år ger ett nytt urval.
+        """
+        week_text = ' '.join(
+            f"{nl['subject']} {(nl.get('text') or nl['snippet'])[:VIDEO_QUERY_CHARS]}"
+            for nl in newsletters
+        )
+        seed = self.video_seed if self.video_seed is not None else f"{datetime.now().year}-W{week_number:02d}"
+        return get_video_index(videos).select(week_text, count, seed=seed)
+    
+    def analyze_week(self, newsletters, youtube_videos, week_number):
+        """Analysera veckan och generera Markdown-sammanfattning + kort beskrivning"""
+        
+        # Välj YouTube-videos som passar veckans tema
+        selected_videos = self._select_videos(youtube_videos, newsletters, week_number, count=10)
+        
+        # Många newsletters: kondensera först (map) och bygg sammanfattningen av anteckningarna (reduce)
+        notes = None
+        if self._use_map_reduce(newsletters):
+            if self.summary_mode == 'batch':
+                notes = self._batch_newsletters(newsletters)
+            else:
+                notes = self._map_newsletters(newsletters)
+        
+        # Bygg prompt med all data
+        prompt = self._build_analysis_prompt(newsletters, selected_videos, week_number, notes=notes)
+        
+        if self.output_mode == 'structured':
+            result = self._analyze_structured(prompt, newsletters, selected_videos, week_number)
+            if result:
+                return result
+            print("Strukturerat svar kunde inte tolkas - använder separata anrop")
+        
+        # Sammanfattningen och Teams-punkterna är oberoende - kör dem parallellt så att
+        # total tid blir det långsammaste anropet istället för summan
+        pool = ThreadPoolExecutor(max_workers=2)
+        summary_future = pool.submit(
+            self._create_message,
+            'summary',
+            max_tokens=self._summary_max_tokens(_source_count(newsletters)),
+            temperature=0.7,
+            system=self._system_blocks(ANALYSIS_INSTRUCTIONS),
+            messages=[
+                {
+                    "role": "user",
+                    "content": prompt
+                }
+            ]
+        )
+        short_future = pool.submit(self._generate_short_description, newsletters, selected_videos, week_number)
+        
+        # ClaudeClient håller deadline per anrop (inklusive omförsök) - lite marginal här
+        deadline = self.api.deadline + 10
+        try:
+            markdown_content = summary_future.result(timeout=deadline)
+            short_description = short_future.result(timeout=deadline)
+        except Exception:
+            # Avbryt det som inte hunnit starta och vänta inte på resten
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        pool.shutdown()
+        
+        # Extrahera YouTube-picks från resultatet (för databas)
+        youtube_picks = self._extract_youtube_picks(markdown_content, selected_videos)
+        
+        return {
+            'markdown': markdown_content,
+            'short_description': short_description,
+            'youtube_picks': youtube_picks
+        }
+    
+    def _analyze_structured(self, prompt, newsletters, videos, week_number):
+        """Sammanfattning, Teams-punkter och videoval i ett enda anrop
+        
+        Saknade eller ogiltiga punkter/video-id:n ersätts var för sig (extra anrop
+        respektive länkarna i Markdown). Returnerar None om sammanfattningen saknas.
+        """
+        text = self._create_message(
+            'summary_structured',
+            max_tokens=self._summary_max_tokens(_source_count(newsletters), extra=300),
+            temperature=0.7,
+            system=self._system_blocks(ANALYSIS_INSTRUCTIONS, STRUCTURED_OUTPUT_INSTRUCTIONS),
+            messages=[{"role": "user", "content": prompt}]
+        )
+        sections = self._parse_structured_response(text, videos)
+        if not sections['markdown']:
+            return None
+        
+        if sections['bullets']:
+            short_description = self._format_short_description(sections['bullets'], week_number)
+        else:
+            print("Teams-punkter saknas i strukturerat svar - genererar separat")
+            short_description = self._generate_short_description(newsletters, videos, week_number)
+        
+        youtube_picks = sections['video_ids']
+        if youtube_picks is None:
+            youtube_picks = self._extract_youtube_picks(sections['markdown'], videos)
+        
+        return {
+            'markdown': sections['markdown'],
+            'short_description': short_description,
+            'youtube_picks': youtube_picks
+        }
+    
+    def _parse_structured_response(self, text, videos):
+        """Strikt tolkning av de taggade sektionerna - ogiltiga sektioner blir None
+        
+        Varje sektion måste finnas exakt en gång. Punkterna måste vara 3-6 st och
+        video-id:n måste finnas bland de videos som skickades med.
+        """
+        sections = dict.fromkeys(STRUCTURED_SECTIONS)
+        raw = {}
+        for name in STRUCTURED_SECTIONS:
+            matches = re.findall(rf'<{name}>(.*?)</{name}>', text, re.DOTALL)
+            if len(matches) == 1:
+                raw[name] = matches[0].strip()
+        
+        if raw.get('markdown'):
+            sections['markdown'] = raw['markdown']
+        
+        bullet_lines = [line for line in raw.get('bullets', '').splitlines() if line.strip()]
+        bullets = [BULLET_RE.match(line) for line in bullet_lines]
+        if bullets and all(bullets) and 3 <= len(bullets) <= 6:
+            sections['bullets'] = '\n'.join(f"• {match.group(1).strip()}" for match in bullets)
+        
+        if 'video_ids' in raw:
+            valid_ids = {str(video.get('id')): video.get('id') for video in videos}
+            tokens = [token for token in re.split(r'[\s,]+', raw['video_ids']) if token]
+            if tokens and all(token in valid_ids for token in tokens):
+                sections['video_ids'] = list(dict.fromkeys(valid_ids[token] for token in tokens))
+        
+        return sections
+    
+    def _system_blocks(self, *texts):
+        """System-prompt som textblock - sista blocket markeras för prompt caching
+        
+        Cachen gäller hela prefixet fram till markeringen, så alla block ska vara statiska.
+        """
+        blocks = [{"type": "text", "text": text} for text in texts]
+        blocks[-1]["cache_control"] = {"type": "ephemeral"}
+        return blocks
+    
+    def _use_map_reduce(self, newsletters):
+        """Map-reduce används alltid i lägena 'mapreduce' och 'batch', och i 'auto' när det är fler än 30 newsletters"""
+        if self.summary_mode in ('mapreduce', 'batch'):
+            return True
+        return self.summary_mode == 'auto' and len(newsletters) > 30
+    
+    def _map_newsletters(self, newsletters):
+        """Map-fas: extrahera nyckelpunkter per newsletter med parallella anrop i små grupper
+        
+        Returnerar en anteckning per newsletter. Om en grupp misslyckas används
+        snippet för den gruppen istället.
+        """
+        groups = [
+            list(range(start, min(start + self.map_group_size, len(newsletters))))
+            for start in range(0, len(newsletters), self.map_group_size)
+        ]
+        notes = [f"- {nl['snippet'][:300]}" for nl in newsletters]
+        
+        print(f"Map-fas: {len(newsletters)} newsletters i {len(groups)} grupper")
+        with ThreadPoolExecutor(max_workers=self.map_concurrency) as pool:
+            futures = {
+                pool.submit(self._map_group, [newsletters[i] for i in group], group_number): group
+                for group_number, group in enumerate(groups)
+            }
+            for future, group in futures.items():
+                try:
+                    group_notes = future.result()
+                except Exception as e:
+                    print(f"Map-anrop för grupp {group[0] // self.map_group_size + 1} misslyckades: {e}")
+                    continue
+                for offset, i in enumerate(group):
+                    if group_notes.get(offset + 1):
+                        notes[i] = group_notes[offset + 1]
+        
+        return notes
+    
+    def _map_group(self, newsletters, group_number):
+        """Extrahera nyckelpunkter för en grupp newsletters - returnerar {nummer: punkter}"""
+        text = self._create_message(f'map_{group_number + 1}', **self._map_request(newsletters))
+        return self._parse_map_response(text)
+    
+    def _map_request(self, newsletters):
+        """Parametrar för ett map-anrop (utan modell) för en grupp newsletters"""
+        content = ""
+        for i, nl in enumerate(newsletters, 1):
+            # Utdragen brödtext om den finns, annars Gmails snippet
+            body = nl.get('text') or nl['snippet']
+            content += f"\n[{i}] Från: {nl['from']}\nÄmne: {nl['subject']}\n{body[:self.map_chars_per_newsletter]}\n"
+        
+        prompt = f"""Extrahera de viktigaste nyheterna ur varje newsletter nedan.
+
+{content}
+
+Svara med ENDAST detta format, ett block per newsletter i samma ordning:
+[1]
+- Nyckelpunkt (max 25 ord, behåll namn, siffror och produktnamn)
+- Nyckelpunkt
+[2]
+- ...
+
+2-4 punkter per newsletter. Skriv på svenska."""
+
+        return {
+            'max_tokens': 150 * len(newsletters) + 100,
+            'temperature': 0.3,
+            'messages': [{"role": "user", "content": prompt}]
+        }
+    
+    def _batch_newsletters(self, newsletters):
+        """Map-fas som Message Batch: ett anrop per newsletter, körs asynkront
+        
+        Svar som redan finns i svarscachen skickas inte. Om jobbet misslyckas
+        eller inte blir klart i tid körs map-fasen interaktivt istället.
+        """
+        notes = [f"- {nl['snippet'][:300]}" for nl in newsletters]
+        requests = {}
+        keys = {}
+        for i, nl in enumerate(newsletters):
+            params = {'model': self.model, **self._map_request([nl])}
+            key = request_key(**params)
+            cached = self.cache.get(key) if self.cache else None
+            if cached is not None:
+                notes[i] = self._parse_map_response(cached).get(1, notes[i])
+                continue
+            requests[f'nl-{i}'] = params
+            keys[f'nl-{i}'] = key
+        
+        print(f"Batch-läge: {len(requests)} av {len(newsletters)} newsletters skickas, resten från cache")
+        try:
+            texts = self._batch_job().run(requests)
+        except Exception as e:
+            print(f"Batch-jobbet misslyckades ({e}) - kör map-fasen interaktivt")
+            return self._map_newsletters(newsletters)
+        
+        for custom_id, text in texts.items():
+            if self.cache:
+                self.cache.put(keys[custom_id], text)
+            i = int(custom_id.split('-', 1)[1])
+            notes[i] = self._parse_map_response(text).get(1, notes[i])
+        
+        return notes
+    
+    def _batch_job(self):
+        """Batch-jobb mot Message Batches-API:t eller den lokala ersättningen"""
+        if self.batch_backend == 'local':
+            batches = LocalMessageBatches(
+                lambda params: self._create_message(
+                    'batch_local', **{k: v for k, v in params.items() if k != 'model'}
+                )
+            )
+        else:
+            # Nyare SDK-versioner har batches utanför beta
+            batches = getattr(self.client.messages, 'batches', None) or self.client.beta.messages.batches
+        return MessageBatchJob(
+            batches,
+            state_file=self.batch_state_file,
+            poll_interval=self.batch_poll_interval,
+            max_wait=self.batch_max_wait
+        )
+    
+    def _parse_map_response(self, text):
+        """Tolka '[N]'-block från map-svaret till {N: punkter}"""
+        notes = {}
+        current = None
+        for line in text.splitlines():
+            match = MAP_MARKER_RE.match(line.strip())
+            if match:
+                current = int(match.group(1))
+                notes[current] = []
+            elif current is not None and line.strip():
+                notes[current].append(line.strip())
+        return {number: '\n'.join(lines) for number, lines in notes.items() if lines}
+    
+    def _create_message(self, name, **kwargs):
+        """Anropa Claude och returnera svarstexten - loggar latens och tokenanvändning
+        
+        Svar för identiska anrop (modell, parametrar och prompt) hämtas från
+        den lokala svarscachen om den är påslagen.
+        """
+        key = request_key(model=self.model, **kwargs)
+        if self.cache:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.call_stats.append({'name': name, 'seconds': 0, 'input_tokens': 0, 'output_tokens': 0, 'cached': True})
+                print(f"✓ Claude-anrop '{name}': från lokal cache")
+                return cached
+        
+        start = time.monotonic()
+        try:
+            response = self.api.create(model=self.model, **kwargs)
+        except Exception as e:
+            print(f"Claude-anrop '{name}' misslyckades efter {time.monotonic() - start:.1f}s: {e}")
+            raise
+        
+        elapsed = time.monotonic() - start
+        usage = response.usage
+        # Tokens som lästs från/skrivits till Anthropics prompt-cache (saknas om inget cachats)
+        cache_read = getattr(usage, 'cache_read_input_tokens', None) or 0
+        cache_write = getattr(usage, 'cache_creation_input_tokens', None) or 0
+        self.call_stats.append({
+            'name': name,
+            'seconds': round(elapsed, 2),
+            'input_tokens': usage.input_tokens,
+            'output_tokens': usage.output_tokens,
+            'cache_read_tokens': cache_read,
+            'cache_write_tokens': cache_write
+        })
+        cache_info = f", prompt-cache {cache_read} läst / {cache_write} skrivet" if cache_read or cache_write else ""
+        if not cache_read and not cache_write and _uses_prompt_cache(kwargs):
+            print(
+                f"Varning: prompt-cachen användes inte för '{name}' - prefixet är troligen kortare "
+                f"än {PROMPT_CACHE_MIN_TOKENS} tokens"
+            )
+        print(f"✓ Claude-anrop '{name}': {elapsed:.1f}s ({usage.input_tokens} in / {usage.output_tokens} ut{cache_info})")
+        
+        text = response.content[0].text
+        # Avklippta svar cachas inte - nästa körning ska få en ny chans
+        if self.cache and response.stop_reason != 'max_tokens':
+            self.cache.put(key, text)
+        return text
+    
+    def _report_packing(self, name, stats):
+        """Logga hur stor den packade prompten blev"""
+        print(
+            f"Prompt '{name}': ~{stats['tokens']}/{stats['budget']} tokens, {stats['blocks']} block "
+            f"({stats['truncated']} förkortade, {stats['dropped']} utelämnade)"
+        )
+    
+    def _summary_max_tokens(self, newsletter_count, extra=0):
+        """Svarsutrymme för sammanfattningen - listan med alla newsletters växer med antalet
+
+        Taket är 16000 tokens, eller output-gränsen per minut om den är lägre.
+        """
+        limit = 16000
+        if self.api.output_tokens.enabled:
+            limit = min(limit, self.api.output_tokens.capacity)
+        return min(limit, 3000 + 60 * newsletter_count + extra)
+    
+    def _generate_short_description(self, newsletters, videos, week_number):
+        """Generera kort beskrivning för Teams-inlägg"""
+        
+        # Ämnesraderna packas inom en liten budget - långa ämnen kortas först
+        blocks = [{'header': '\n- ', 'body': nl['subject'], 'priority': 1} for nl in newsletters]
+        texts, stats = pack_blocks(blocks, self.short_input_budget, min_body_tokens=10)
+        self._report_packing('short_description', stats)
+        subjects = ''.join(text for text in texts if text)
+        
+        topics_prompt = f"""Baserat på dessa newsletters, skapa en kort punktlista med 4-5 nyckelhändelser denna vecka.
+
+NEWSLETTERS (ämnesrader):{subjects}
+
+Skapa ENDAST en bullet-lista med 4-5 korta punkter (max 8 ord per punkt). Format:
+• Punkt 1
+• Punkt 2
+• Punkt 3
+etc.
+
+VIKTIGT: Bara bullets, ingen annan text."""
+
+        bullets = self._create_message(
+            'short_description',
+            max_tokens=200,
+            temperature=0.5,
+            messages=[{"role": "user", "content": topics_prompt}]
+        )
+        return self._format_short_description(bullets.strip(), week_number)
+    
+    def _format_short_description(self, bullets, week_number):
+        """Bygg kort meddelande för Teams"""
+        short_msg = f"""🤖 AI-veckans sammanfattning är uppdaterad (Vecka {week_number})
+
+Den här veckan:
+{bullets}
+
+⏱️ Lästid: ~5–6 min  
+👉 Full sammanfattning finns i fliken ovan"""
+        
+        return short_msg
+    
+    def _build_analysis_prompt(self, newsletters, youtube_videos, week_number, notes=None):
+        """Bygg veckans data för Claude - instruktionerna ligger i ANALYSIS_INSTRUCTIONS
+        
+        notes: nyckelpunkter per newsletter från map-fasen, används istället för
+        brödtexten. Allt packas inom self.input_budget tokens - långa texter kortas
+        hellre än att hela newsletters utelämnas.
+        """
+        
+        # Videos först (få och korta), därefter newsletters
+        blocks = []
+        for i, video in enumerate(youtube_videos, 1):
+            blocks.append({
+                'header': (
+                    f"\n{i}. **{video['title']}**\n"
+                    f"   - Video-id: {video.get('id')}\n"
+                    f"   - URL: {video['url']}\n"
+                    f"   - Kategori: {video['category']}\n"
+                    f"   - Typ: {video['type']}\n"
+                    f"   - Beskrivning: "
+                ),
+                'body': f"{video['description']}\n",
+                'priority': 2
+            })
+        
+        for i, nl in enumerate(newsletters, 1):
+            # Källor med samma innehåll (från dubblettsökningen) listas med sina länkar
+            duplicates = ''.join(
+                f"- {dup['from']}: {dup['subject']} ({dup['drive_url']})\n"
+                for dup in nl.get('duplicates', [])
+            )
+            if notes is not None:
+                body = f"**Nyckelpunkter:**\n{notes[i - 1]}\n"
+            else:
+                # Utdragen brödtext om den finns, annars Gmails snippet
+                body = f"**Innehåll:** {nl.get('text') or nl['snippet']}\n"
+            blocks.append({
+                'header': (
+                    f"\n## Newsletter {i}\n"
+                    f"**Från:** {nl['from']}\n"
+                    f"**Ämne:** {nl['subject']}\n"
+                    f"**Drive-länk:** {nl['drive_url']}\n"
+                    + (f"**Samma innehåll även i:**\n{duplicates}" if duplicates else "")
+                ),
+                'body': body,
+                'priority': 1
+            })
+        
+        budget = self.input_budget - estimate_tokens(ANALYSIS_INSTRUCTIONS)
+        texts, stats = pack_blocks(blocks, budget)
+        self._report_packing('summary', stats)
+        
+        youtube_summary = ''.join(text for text in texts[:len(youtube_videos)] if text)
+        newsletter_texts = texts[len(youtube_videos):]
+        newsletters_summary = ''.join(text for text in newsletter_texts if text)
+        source_count = _source_count([nl for nl, text in zip(newsletters, newsletter_texts) if text])
+        
+        prompt = f"""# VECKA
+{week_number}
+
+# NEWSLETTERS FRÅN VECKAN ({source_count} st inklusive dubbletter)
+{newsletters_summary}
+
+# TILLGÄNGLIGA YOUTUBE-VIDEOS
+{youtube_summary}
 
 Skapa sammanfattningen nu:"""
 
         return prompt
     
-    def _extract_youtube_picks(self, markdown):
-        """Extrahera valda YouTube-videos från Markdown (förenklad)"""
-        # Förenklad extraktion - returnera tom lista
-        # Kan förbättras senare om vi behöver spara detta strukturerat
-        return []
+    def _extract_youtube_picks(self, markdown, videos):
+        """Fallback för videoval: id för de videos som länkas i Markdown
+
+        Hela länkmålet måste stämma - youtu.be/abc ska inte matcha youtu.be/abcd.
+        """
+        targets = set(LINK_TARGET_RE.findall(markdown))
+        return [video.get('id') for video in videos if video['url'] in targets]
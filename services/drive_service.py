@@ -1,29 +1,125 @@
-"""Google Drive Service - Sparar PDF-kopior av newsletters med Playwright"""
+"""Google Drive Service - Sparar kopior av newsletters (PDF via Playwright eller lättviktsformat)"""
 
 import os
+import re
 import json
+import time
+import random
+import hashlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait
 from io import BytesIO
-from playwright.sync_api import sync_playwright
+import httplib2
+import requests
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaIoBaseUpload
 
+from services.pdf_renderer import MAX_ASSET_BYTES, PdfRenderer, is_blocked_url, pack_asset, unpack_asset
+from utils.disk_cache import DiskCache
+from utils.html_archive import sanitize_html, downscale_image, image_urls, to_data_uri
+from utils.html_text import html_to_markdown, html_to_text
+from utils.pdf_optimizer import optimize_pdf
+
 SCOPES = ['https://www.googleapis.com/auth/drive.file']
 
+HTML_COMMENT_RE = re.compile(r'<!--.*?-->', re.DOTALL)
+WHITESPACE_RE = re.compile(r'\s+')
+
+# Länken till en fil går att räkna ut från ID:t, även innan filen laddats upp
+DRIVE_FILE_URL = 'https://drive.google.com/file/d/{file_id}/view?usp=drivesdk'
+
+# Veckomappar per parent/namn - delas mellan körningar i samma process
+FOLDER_CACHE = {}
+
+# Arkivformat: (filändelse, mimetype)
+ARCHIVE_FORMATS = {
+    'pdf': ('pdf', 'application/pdf'),
+    'html': ('html', 'text/html'),
+    'markdown': ('md', 'text/markdown'),
+    'text': ('txt', 'text/plain'),
+}
+
+def create_renderer():
+    """Skapa en PdfRenderer konfigurerad från environment variables"""
+    # Lokal cache för bilder, typsnitt och CSS (tom sökväg stänger av cachen)
+    asset_cache_path = os.getenv('DRIVE_ASSET_CACHE_PATH', 'asset_cache.sqlite3')
+    asset_cache_max_mb = int(os.getenv('DRIVE_ASSET_CACHE_MAX_MB', '300'))
+    asset_cache = DiskCache(asset_cache_path, asset_cache_max_mb * 1024 * 1024) if asset_cache_path else None
+    blocked_domains = [d.strip() for d in os.getenv('DRIVE_BLOCKED_DOMAINS', '').split(',') if d.strip()]
+    
+    return PdfRenderer(
+        concurrency=int(os.getenv('DRIVE_RENDER_CONCURRENCY', '4')),
+        timeout=int(os.getenv('DRIVE_RENDER_TIMEOUT', '30')),
+        network_budget=float(os.getenv('DRIVE_NETWORK_BUDGET', '5')),
+        asset_cache=asset_cache,
+        blocked_domains=blocked_domains,
+        max_renders=int(os.getenv('DRIVE_RENDER_MAX_JOBS', '200')),
+        max_memory_mb=int(os.getenv('DRIVE_RENDER_MAX_MEMORY_MB', '1024'))
+    )
+
 class DriveService:
-    def __init__(self):
+    def __init__(self, renderer=None):
         self.service = self._authenticate()
         self.parent_folder_id = os.getenv('GOOGLE_DRIVE_FOLDER_ID')
-        self.playwright = None
-        self.browser = None
+        self.state_file = os.getenv('DRIVE_STATE_FILE', 'drive_state.json')
+        
+        # En delad renderare (t.ex. från web-appen) ägs inte av tjänsten och stängs inte här
+        self.owns_renderer = renderer is None
+        self.renderer = renderer or create_renderer()
+        
+        # {folder_id: {contentHash: file_info}} för redan arkiverade newsletters
+        self.files_by_hash = {}
+        
+        # Uppladdning sker i en egen trådpool så att den överlappar med renderingen
+        self.upload_workers = int(os.getenv('DRIVE_UPLOAD_WORKERS', '4'))
+        self.upload_retries = int(os.getenv('DRIVE_UPLOAD_RETRIES', '3'))
+        self.resumable_threshold = int(os.getenv('DRIVE_RESUMABLE_THRESHOLD_MB', '5')) * 1024 * 1024
+        self.http_local = threading.local()
+        
+        # Arkivformat: pdf (default), html, markdown eller text - kan styras per avsändare
+        self.archive_format = os.getenv('DRIVE_ARCHIVE_FORMAT', 'pdf')
+        self.sender_formats = self._parse_sender_formats(os.getenv('DRIVE_ARCHIVE_FORMAT_BY_SENDER', ''))
+        if self.archive_format not in ARCHIVE_FORMATS:
+            raise ValueError(f"Okänt DRIVE_ARCHIVE_FORMAT: {self.archive_format}")
+        self.image_max_width = int(os.getenv('DRIVE_ARCHIVE_IMAGE_WIDTH', '800'))
+        self.image_quality = int(os.getenv('DRIVE_ARCHIVE_IMAGE_QUALITY', '70'))
+        # Bilderna i ett HTML-arkiv hämtas parallellt inom en gemensam tidsbudget
+        self.image_workers = int(os.getenv('DRIVE_ARCHIVE_IMAGE_WORKERS', '8'))
+        self.image_budget = float(os.getenv('DRIVE_ARCHIVE_IMAGE_BUDGET', '15'))
+        
+        # Valfri optimering av PDF:er innan uppladdning
+        self.optimize_pdfs = os.getenv('DRIVE_PDF_OPTIMIZE', 'false').lower() == 'true'
+        self.pdf_target_dpi = int(os.getenv('DRIVE_PDF_TARGET_DPI', '150'))
+        self.pdf_jpeg_quality = int(os.getenv('DRIVE_PDF_JPEG_QUALITY', '75'))
+        self.pdf_bytes_before = 0
+        self.pdf_bytes_after = 0
+        self.stats_lock = threading.Lock()
+    
+    def _parse_sender_formats(self, value):
+        """Tolka 'substack.com=html,news@foo.com=markdown' till [(mönster, format)]"""
+        sender_formats = []
+        for item in value.split(','):
+            if not item.strip():
+                continue
+            pattern, _, archive_format = item.partition('=')
+            archive_format = archive_format.strip()
+            if archive_format not in ARCHIVE_FORMATS:
+                raise ValueError(f"Okänt arkivformat för {pattern.strip()}: {archive_format}")
+            sender_formats.append((pattern.strip().lower(), archive_format))
+        return sender_formats
     
     def __del__(self):
         """Cleanup Playwright resources"""
-        if self.browser:
-            self.browser.close()
-        if self.playwright:
-            self.playwright.stop()
+        self.close()
+    
+    def close(self):
+        """Stäng PDF-renderaren om tjänsten äger den"""
+        if getattr(self, 'owns_renderer', False) and self.renderer:
+            self.renderer.close()
     
     def _authenticate(self):
         """Autentisera med Drive API"""
@@ -36,20 +132,40 @@ class DriveService:
         if creds and creds.expired and creds.refresh_token:
             creds.refresh(Request())
         
+        self.creds = creds
         return build('drive', 'v3', credentials=creds)
     
-    def _get_browser(self):
-        """Lazy load Playwright browser"""
-        if not self.playwright:
-            self.playwright = sync_playwright().start()
-            self.browser = self.playwright.chromium.launch(
-                headless=True,
-                args=['--no-sandbox', '--disable-setuid-sandbox']
-            )
-        return self.browser
-    
     def create_weekly_folder(self, folder_name):
-        """Skapa veckomapp om den inte finns"""
+        """Skapa veckomapp om den inte finns (ID:t cachas i minnet och i state-filen)"""
+        cache_key = f"{self.parent_folder_id}/{folder_name}"
+        folder_id = FOLDER_CACHE.get(cache_key) or self._load_state().get('folders', {}).get(cache_key)
+        if folder_id and self._folder_exists(folder_id):
+            FOLDER_CACHE[cache_key] = folder_id
+            return folder_id
+        if folder_id:
+            print(f"Cachad mapp {folder_name} finns inte längre på Drive - slår upp den igen")
+        
+        folder_id = self._find_or_create_folder(folder_name)
+        
+        FOLDER_CACHE[cache_key] = folder_id
+        state = self._load_state()
+        state.setdefault('folders', {})[cache_key] = folder_id
+        self._save_state(state)
+        
+        return folder_id
+    
+    def _folder_exists(self, folder_id):
+        """Billig kontroll att en cachad mapp finns kvar och inte ligger i papperskorgen"""
+        try:
+            folder = self.service.files().get(fileId=folder_id, fields='id, trashed').execute(num_retries=2)
+        except HttpError as e:
+            if e.resp.status == 404:
+                return False
+            raise
+        return not folder.get('trashed', False)
+    
+    def _find_or_create_folder(self, folder_name):
+        """Slå upp veckomappen på Drive och skapa den om den saknas"""
         query = f"name='{folder_name}' and '{self.parent_folder_id}' in parents and mimeType='application/vnd.google-apps.folder' and trashed=false"
         
         results = self.service.files().list(
@@ -84,66 +200,355 @@ class DriveService:
         
         return folder['id']
     
+    def _load_state(self):
+        """Läs lokal Drive-state (cachade mapp-ID:n)"""
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            print(f"Kunde inte läsa Drive-state: {e}")
+            return {}
+    
+    def _save_state(self, state):
+        """Spara Drive-state atomiskt"""
+        try:
+            tmp_path = f"{self.state_file}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.state_file)
+        except Exception as e:
+            print(f"Kunde inte spara Drive-state: {e}")
+    
+    def generate_ids(self, count):
+        """Reservera fil-ID:n på Drive i förväg (max 1000 per anrop)"""
+        ids = []
+        while len(ids) < count:
+            batch = min(count - len(ids), 1000)
+            result = self.service.files().generateIds(count=batch, space='drive', type='files').execute()
+            ids.extend(result['ids'])
+        return ids
+    
+    def plan_files(self, newsletters, folder_id, archive_format=None):
+        """Bestäm fil-ID och länk för varje newsletter innan något renderas eller laddas upp
+        
+        Redan arkiverade newsletters (samma innehållshash) får den befintliga filen,
+        övriga får ett reserverat ID - så länkarna är kända direkt och senare steg
+        kan starta medan uppladdningen pågår.
+        """
+        formats = [archive_format or self._archive_format(nl) for nl in newsletters]
+        existing = self._get_files_by_hash(folder_id)
+        hashes = [self._content_hash(nl['html_body'], fmt) for nl, fmt in zip(newsletters, formats)]
+        
+        missing = [content_hash for content_hash in hashes if content_hash not in existing]
+        reserved_ids = iter(self.generate_ids(len(missing)) if missing else [])
+        
+        plans = []
+        for archive_format, content_hash in zip(formats, hashes):
+            if content_hash in existing:
+                plans.append({**existing[content_hash], 'format': archive_format, 'hash': content_hash, 'existing': True})
+            else:
+                file_id = next(reserved_ids)
+                plans.append({
+                    'id': file_id,
+                    'url': DRIVE_FILE_URL.format(file_id=file_id),
+                    'format': archive_format,
+                    'hash': content_hash,
+                    'existing': False
+                })
+        return plans
+    
     def save_newsletter(self, newsletter, folder_id):
         """Spara newsletter som PDF med Playwright"""
-        safe_subject = "".join(c for c in newsletter['subject'] if c.isalnum() or c in (' ', '-', '_')).strip()
-        safe_subject = safe_subject[:50]
-        filename = f"{safe_subject}.pdf"
+        return self.save_newsletters([newsletter], folder_id)[0]
+    
+    def save_newsletters(self, newsletters, folder_id, archive_format=None, plans=None):
+        """Arkivera flera newsletters på Drive - PDF:er renderas parallellt
         
-        try:
-            print(f"Converting {safe_subject} to PDF with Playwright...")
-            
-            browser = self._get_browser()
-            page = browser.new_page()
-            
-            # Ladda HTML
-            page.set_content(newsletter['html_body'], wait_until='networkidle')
-            
-            # Generera PDF
-            pdf_bytes = page.pdf(
-                format='A4',
-                print_background=True,
-                margin={'top': '20px', 'right': '20px', 'bottom': '20px', 'left': '20px'}
-            )
+        Formatet väljs per körning (archive_format) eller per avsändare, se
+        _archive_format(). plans kommer från plan_files() - utan plans görs
+        planeringen här. Newsletters som redan finns arkiverade i mappen sparas
+        inte igen - den befintliga filen returneras istället.
+        
+        Returnerar en lista med {'id', 'url', 'format'} (eller None om både
+        arkivering och text-fallback misslyckades) i samma ordning som newsletters.
+        """
+        if plans is None:
+            plans = self.plan_files(newsletters, folder_id, archive_format)
+        
+        results = [
+            {'id': plan['id'], 'url': plan['url'], 'format': plan['format']} if plan['existing'] else None
+            for plan in plans
+        ]
+        
+        pending = [i for i, plan in enumerate(plans) if not plan['existing']]
+        skipped = len(newsletters) - len(pending)
+        if skipped:
+            print(f"✓ {skipped} newsletters finns redan på Drive - hoppar över")
+        if not pending:
+            return results
+        
+        to_render = [i for i in pending if plans[i]['format'] == 'pdf']
+        lightweight = [i for i in pending if plans[i]['format'] != 'pdf']
+        
+        # Varje fil laddas upp så fort den är klar, medan resten fortfarande renderas
+        with ThreadPoolExecutor(max_workers=self.upload_workers) as pool:
+            upload_futures = {}
             
-            page.close()
+            # Lättviktsformaten behöver ingen browser och kan starta direkt
+            for i in lightweight:
+                upload_future = pool.submit(self._store_lightweight, newsletters[i], plans[i], folder_id)
+                upload_futures[upload_future] = i
             
-            # Ladda upp till Drive
-            pdf_buffer = BytesIO(pdf_bytes)
+            if to_render:
+                print(f"Converting {len(to_render)} newsletters to PDF with Playwright...")
+                try:
+                    render_futures = self.renderer.submit_many([newsletters[i]['html_body'] for i in to_render])
+                except Exception as e:
+                    # Browsern kunde inte startas - varje rendering blir text-fallback
+                    print(f"Kunde inte starta PDF-renderaren: {e!r}")
+                    render_futures = [Future() for _ in to_render]
+                    for render_future in render_futures:
+                        render_future.set_exception(e)
+                index_of = dict(zip(render_futures, to_render))
+                
+                for render_future in as_completed(render_futures):
+                    i = index_of[render_future]
+                    upload_future = pool.submit(self._store_rendered, newsletters[i], render_future, plans[i], folder_id)
+                    upload_futures[upload_future] = i
             
-            file_metadata = {
-                'name': filename,
-                'parents': [folder_id],
-                'mimeType': 'application/pdf'
-            }
+            for upload_future in as_completed(upload_futures):
+                i = upload_futures[upload_future]
+                results[i] = upload_future.result()
+        
+        existing = self._get_files_by_hash(folder_id)
+        for i in pending:
+            if results[i] and results[i]['format'] != 'fallback':
+                existing[plans[i]['hash']] = results[i]
+        
+        return results
+    
+    def save_placeholder(self, newsletter, folder_id, file_id):
+        """Minimal platshållare under ett reserverat ID vars arkivering misslyckades
+        
+        Länken till file_id kan redan finnas i sammanfattningen - utan fil pekar
+        den ingenstans. Kastar fel om inte heller platshållaren kan laddas upp.
+        """
+        content = (
+            f"Subject: {newsletter['subject']}\nFrom: {newsletter['from']}\nDate: {newsletter['date']}\n\n"
+            f"Newslettern kunde inte arkiveras.\n\n{newsletter['snippet']}\n"
+        )
+        file_metadata = {
+            'name': f"{self._safe_subject(newsletter)}.txt",
+            'parents': [folder_id],
+            'mimeType': 'text/plain',
+            'id': file_id
+        }
+        file = self._upload(file_metadata, content.encode('utf-8'), 'text/plain')
+        return {'id': file['id'], 'url': file['webViewLink'], 'format': 'placeholder'}
+    
+    def _archive_format(self, newsletter):
+        """Välj arkivformat - första matchande avsändarmönster, annars default"""
+        sender = newsletter.get('from', '').lower()
+        for pattern, archive_format in self.sender_formats:
+            if pattern in sender:
+                return archive_format
+        return self.archive_format
+    
+    def _store_rendered(self, newsletter, render_future, plan, folder_id):
+        """Ladda upp en renderad PDF, eller text-fallback om renderingen misslyckades"""
+        safe_subject = self._safe_subject(newsletter)
+        try:
+            pdf = render_future.result()
+            if self.optimize_pdfs:
+                pdf = self._optimize_pdf(pdf, safe_subject)
+            return self._upload_archive(pdf, f"{safe_subject}.pdf", 'pdf', folder_id, plan['hash'], plan['id'])
+        except Exception as e:
+            print(f"Fel vid PDF-konvertering för {safe_subject}: {e!r}")
+        
+        return self._try_text_fallback(newsletter, folder_id, safe_subject, plan['id'])
+    
+    def _optimize_pdf(self, pdf, safe_subject):
+        """Komprimera om bilder i PDF:en - vid fel laddas originalet upp"""
+        try:
+            optimized, stats = optimize_pdf(pdf, self.pdf_target_dpi, self.pdf_jpeg_quality)
+        except Exception as e:
+            print(f"Kunde inte optimera PDF för {safe_subject}: {e}")
+            return pdf
+        
+        print(f"PDF {safe_subject}: {stats['before'] / 1024:.0f} KB → {stats['after'] / 1024:.0f} KB ({stats['images']} bilder)")
+        with self.stats_lock:
+            self.pdf_bytes_before += stats['before']
+            self.pdf_bytes_after += stats['after']
+        return optimized
+    
+    def _store_lightweight(self, newsletter, plan, folder_id):
+        """Arkivera som sanerad HTML, Markdown eller text - utan browser"""
+        safe_subject = self._safe_subject(newsletter)
+        archive_format = plan['format']
+        try:
+            if archive_format == 'html':
+                images = self._inline_images(newsletter['html_body'])
+                content = sanitize_html(newsletter['html_body'], inline_image=images.get)
+            elif archive_format == 'markdown':
+                content = (
+                    f"# {newsletter['subject']}\n\n**Från:** {newsletter['from']}  \n"
+                    f"**Datum:** {newsletter['date']}\n\n{html_to_markdown(newsletter['html_body'])}\n"
+                )
+            else:
+                content = (
+                    f"Subject: {newsletter['subject']}\nFrom: {newsletter['from']}\n"
+                    f"Date: {newsletter['date']}\n\n{html_to_text(newsletter['html_body'])}\n"
+                )
             
-            media = MediaIoBaseUpload(
-                pdf_buffer,
-                mimetype='application/pdf',
-                resumable=True
+            extension, _ = ARCHIVE_FORMATS[archive_format]
+            return self._upload_archive(
+                content.encode('utf-8'),
+                f"{safe_subject}.{extension}",
+                archive_format,
+                folder_id,
+                plan['hash'],
+                plan['id']
             )
-            
-            file = self.service.files().create(
-                body=file_metadata,
-                media_body=media,
-                fields='id, webViewLink'
+        except Exception as e:
+            print(f"Fel vid {archive_format}-arkivering för {safe_subject}: {e!r}")
+        
+        return self._try_text_fallback(newsletter, folder_id, safe_subject, plan['id'])
+    
+    def _try_text_fallback(self, newsletter, folder_id, safe_subject, file_id=None):
+        try:
+            return self._save_as_text_fallback(newsletter, folder_id, safe_subject, file_id)
+        except Exception as e:
+            print(f"Kunde inte spara text-fallback för {safe_subject}: {e}")
+            return None
+    
+    def _inline_images(self, html_body):
+        """Hämta alla bilder parallellt - returnerar {url: data-URI, URL eller None}
+        
+        Bilder som inte hunnit hämtas inom image_budget länkas istället för att bäddas in.
+        """
+        urls = image_urls(html_body)
+        if not urls:
+            return {}
+        
+        pool = ThreadPoolExecutor(max_workers=min(self.image_workers, len(urls)))
+        futures = {pool.submit(self._inline_image, url): url for url in urls}
+        done, not_done = wait(futures, timeout=self.image_budget)
+        pool.shutdown(wait=False, cancel_futures=True)
+        
+        if not_done:
+            print(f"{len(not_done)} bilder hann inte hämtas inom {self.image_budget:.0f}s - länkas istället")
+        images = {url: url for url in urls}
+        for future in done:
+            images[futures[future]] = future.result()
+        return images
+    
+    def _inline_image(self, url):
+        """Hämta en bild (via asset-cachen) och returnera den nedskalad som data-URI"""
+        if is_blocked_url(url, self.renderer.blocked_domains):
+            return None
+        
+        asset_cache = self.renderer.asset_cache
+        cached = unpack_asset(asset_cache.get(url)) if asset_cache else None
+        if cached is not None:
+            _, data = cached
+        else:
+            try:
+                with self._get_session().get(url, timeout=self.renderer.network_budget, stream=True) as response:
+                    response.raise_for_status()
+                    data = _read_limited(response, MAX_ASSET_BYTES)
+            except Exception as e:
+                print(f"Kunde inte hämta bild {url}: {e}")
+                return None
+            if data is None:
+                # För stor för att bädda in eller cacha - länka istället
+                return url
+            if asset_cache:
+                asset_cache.put(url, pack_asset(response.headers, data))
+        
+        try:
+            image_data, mimetype = downscale_image(data, self.image_max_width, self.image_quality)
+        except Exception:
+            # T.ex. SVG eller trasig bild - länka istället för att bädda in
+            return url
+        return to_data_uri(image_data, mimetype)
+    
+    def _content_hash(self, html_body, archive_format='pdf'):
+        """SHA-256 av normaliserad HTML (utan kommentarer och extra whitespace)"""
+        normalized = HTML_COMMENT_RE.sub('', html_body or '')
+        normalized = WHITESPACE_RE.sub(' ', normalized).strip()
+        # Andra format än PDF får en egen hash så att formaten inte krockar
+        if archive_format != 'pdf':
+            normalized = f"{archive_format}:{normalized}"
+        return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+    
+    def _get_files_by_hash(self, folder_id):
+        """Hämta {contentHash: {'id', 'url'}} för arkiverade PDF:er i mappen (cachas per körning)"""
+        if folder_id in self.files_by_hash:
+            return self.files_by_hash[folder_id]
+        
+        files_by_hash = {}
+        page_token = None
+        
+        while True:
+            results = self.service.files().list(
+                q=f"'{folder_id}' in parents and trashed=false",
+                spaces='drive',
+                fields='nextPageToken, files(id, webViewLink, appProperties)',
+                pageSize=1000,
+                pageToken=page_token
             ).execute()
             
-            print(f"✓ PDF created: {filename}")
+            for file in results.get('files', []):
+                content_hash = file.get('appProperties', {}).get('contentHash')
+                if content_hash:
+                    files_by_hash[content_hash] = {
+                        'id': file['id'],
+                        'url': file['webViewLink']
+                    }
             
-            return {
-                'id': file['id'],
-                'url': file['webViewLink']
-            }
-            
-        except Exception as e:
-            print(f"Fel vid PDF-konvertering för {safe_subject}: {e}")
-            return self._save_as_text_fallback(newsletter, folder_id, safe_subject)
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+        
+        self.files_by_hash[folder_id] = files_by_hash
+        return files_by_hash
     
-    def _save_as_text_fallback(self, newsletter, folder_id, safe_subject):
-        """Fallback: Spara som text om PDF misslyckas"""
-        from googleapiclient.http import MediaInMemoryUpload
+    def _safe_subject(self, newsletter):
+        """Filnamnssäker version av ämnesraden"""
+        safe_subject = "".join(c for c in newsletter['subject'] if c.isalnum() or c in (' ', '-', '_')).strip()
+        return safe_subject[:50]
+    
+    def _upload_archive(self, data, filename, archive_format, folder_id, content_hash=None, file_id=None):
+        """Ladda upp en arkiverad newsletter till Drive"""
+        _, mimetype = ARCHIVE_FORMATS[archive_format]
+        file_metadata = {
+            'name': filename,
+            'parents': [folder_id],
+            'mimeType': mimetype
+        }
         
+        # Reserverat ID från plan_files() - länken är redan utdelad
+        if file_id:
+            file_metadata['id'] = file_id
+        
+        # Innehållshash gör att samma newsletter kan hoppas över vid omkörning
+        if content_hash:
+            file_metadata['appProperties'] = {'contentHash': content_hash}
+        
+        file = self._upload(file_metadata, data, mimetype)
+        
+        print(f"✓ {archive_format.upper()} created: {filename}")
+        
+        return {
+            'id': file['id'],
+            'url': file['webViewLink'],
+            'format': archive_format
+        }
+    
+    def _save_as_text_fallback(self, newsletter, folder_id, safe_subject, file_id=None):
+        """Fallback: Spara som text om PDF misslyckas"""
         filename = f"{safe_subject}.txt"
         
         file_metadata = {
@@ -152,21 +557,69 @@ class DriveService:
             'mimeType': 'text/plain'
         }
         
-        content = f"Subject: {newsletter['subject']}\nFrom: {newsletter['from']}\n\n{newsletter['snippet']}"
+        if file_id:
+            file_metadata['id'] = file_id
         
-        media = MediaInMemoryUpload(
-            content.encode('utf-8'),
-            mimetype='text/plain',
-            resumable=True
-        )
+        content = f"Subject: {newsletter['subject']}\nFrom: {newsletter['from']}\n\n{newsletter['snippet']}"
         
-        file = self.service.files().create(
-            body=file_metadata,
-            media_body=media,
-            fields='id, webViewLink'
-        ).execute()
+        file = self._upload(file_metadata, content.encode('utf-8'), 'text/plain')
         
         return {
             'id': file['id'],
-            'url': file['webViewLink']
+            'url': file['webViewLink'],
+            'format': 'fallback'
         }
+    
+    def _upload(self, file_metadata, data, mimetype):
+        """Ladda upp en fil med retry och backoff
+        
+        Små filer skickas som ett enda multipart-anrop, bara stora filer använder
+        resumable upload (som kostar ett extra anrop för att starta sessionen).
+        """
+        resumable = len(data) > self.resumable_threshold
+        
+        # Omförsöken sköts bara här (inte via execute(num_retries)) så att 409-kontrollen stämmer
+        for attempt in range(self.upload_retries + 1):
+            try:
+                media = MediaIoBaseUpload(BytesIO(data), mimetype=mimetype, resumable=resumable)
+                return self.service.files().create(
+                    body=file_metadata,
+                    media_body=media,
+                    fields='id, webViewLink'
+                ).execute(http=self._get_http())
+            except Exception as e:
+                # Med reserverat ID betyder 409 att ett tidigare försök faktiskt lyckades
+                if isinstance(e, HttpError) and e.resp.status == 409 and 'id' in file_metadata and attempt > 0:
+                    file_id = file_metadata['id']
+                    return {'id': file_id, 'webViewLink': DRIVE_FILE_URL.format(file_id=file_id)}
+                if attempt == self.upload_retries:
+                    raise
+                delay = 2 ** attempt + random.uniform(0, 1)
+                print(f"Uppladdning av {file_metadata['name']} misslyckades ({e}) - försöker igen om {delay:.1f}s")
+                time.sleep(delay)
+    
+    def _get_session(self):
+        """En requests-session per tråd för bildhämtning"""
+        if not hasattr(self.http_local, 'session'):
+            self.http_local.session = requests.Session()
+        return self.http_local.session
+    
+    def _get_http(self):
+        """En återanvänd HTTP-anslutning per tråd (httplib2 är inte trådsäkert)"""
+        if not hasattr(self.http_local, 'http'):
+            self.http_local.http = AuthorizedHttp(self.creds, http=httplib2.Http())
+        return self.http_local.http
+
+
+def _read_limited(response, max_bytes):
+    """Läs ett strömmat svar - None om det är större än max_bytes"""
+    if int(response.headers.get('content-length') or 0) > max_bytes:
+        return None
+    chunks = []
+    size = 0
+    for chunk in response.iter_content(64 * 1024):
+        size += len(chunk)
+        if size > max_bytes:
+            return None
+        chunks.append(chunk)
+    return b''.join(chunks)
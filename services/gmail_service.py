@@ -1,19 +1,56 @@
 """Gmail Service - Hämtar newsletters med label 'Newsletters'"""
 
 import os
-import base64
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
+import httplib2
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 import json
 
+from utils.html_text import extract_newsletter_text
+from utils.message_cache import MessageCache
+from utils.mime_body import DEFAULT_MAX_BYTES, extract_body, text_as_html
+
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
 
+NEWSLETTER_LABEL = 'Newsletters'
+
+# Gmail tillåter max 100 anrop per batch, men rekommenderar 50 för att undvika rate limits
+MAX_BATCH_SIZE = 100
+
+# Listningsfasen hämtar bara headers och snippet, body hämtas separat vid behov
+METADATA_HEADERS = ['Subject', 'From', 'Date']
+METADATA_FIELDS = 'id,snippet,labelIds,payload/headers'
+BODY_FIELDS = 'id,payload(mimeType,filename,headers,body,parts)'
+
+# Max antal ID:n per messages.batchModify-anrop
+BATCH_MODIFY_LIMIT = 1000
+
 class GmailService:
     def __init__(self):
+        self.creds = None
         self.service = self._authenticate()
+        
+        # Hämtningsläge: 'batch' (default), 'threads' eller 'sequential'
+        self.fetch_mode = os.getenv('GMAIL_FETCH_MODE', 'batch')
+        self.batch_size = min(int(os.getenv('GMAIL_BATCH_SIZE', '50')), MAX_BATCH_SIZE)
+        self.max_workers = int(os.getenv('GMAIL_MAX_WORKERS', '8'))
+        self.max_body_bytes = int(os.getenv('GMAIL_MAX_BODY_BYTES', str(DEFAULT_MAX_BYTES)))
+        
+        # Fil för historyId-checkpoint och kö vid inkrementell synk
+        self.sync_state_file = os.getenv('GMAIL_SYNC_STATE_FILE', 'gmail_sync_state.json')
+        
+        # Lokal cache för tolkade meddelanden (tom sökväg stänger av cachen)
+        cache_path = os.getenv('GMAIL_CACHE_PATH', 'message_cache.sqlite3')
+        cache_max_mb = int(os.getenv('GMAIL_CACHE_MAX_MB', '200'))
+        self.cache = MessageCache(cache_path, cache_max_mb * 1024 * 1024) if cache_path else None
     
     def _authenticate(self):
         """Autentisera med Gmail API"""
@@ -34,12 +71,11 @@ class GmailService:
             if creds and creds.expired and creds.refresh_token:
                 creds.refresh(Request())
         
+        self.creds = creds
         return build('gmail', 'v1', credentials=creds)
     
-    def get_newsletters_last_week(self):
-        """Hämta newsletters från förra fredagen 08:00 till denna fredagen 08:00"""
-        from datetime import datetime, timedelta
-        
+    def get_last_week_range(self):
+        """Räkna ut intervallet förra fredagen 08:00 till denna fredagen 08:00"""
         now = datetime.now()
         
         # Räkna ut förra fredagen kl 08:00
@@ -50,87 +86,419 @@ class GmailService:
         # Till och med denna fredagen kl 08:00
         this_friday = now.replace(hour=8, minute=0, second=0, microsecond=0)
         
-        query = f'label:Newsletters after:{last_friday.strftime("%Y/%m/%d")} before:{this_friday.strftime("%Y/%m/%d")} is:unread'
+        return last_friday, this_friday
+    
+    def get_newsletters_last_week(self):
+        """Hämta newsletters (inkl. HTML-body och text) från förra fredagen 08:00 till denna fredagen 08:00"""
+        start, end = self.get_last_week_range()
+        newsletters = list(self.iter_newsletters(start, end))
+        
+        bodies = self.get_bodies([nl['id'] for nl in newsletters])
+        for nl in newsletters:
+            nl['html_body'], nl['text'] = bodies.get(nl['id'], ("", ""))
         
-        try:
+        return newsletters
+    
+    def iter_newsletters(self, start=None, end=None, page_size=100):
+        """Generator som följer alla sidor i sökresultatet och yieldar newsletters allt eftersom"""
+        if start is None or end is None:
+            start, end = self.get_last_week_range()
+        
+        query = f'label:{NEWSLETTER_LABEL} after:{start.strftime("%Y/%m/%d")} before:{end.strftime("%Y/%m/%d")} is:unread'
+        
+        for msg_ids in self._iter_message_id_pages(query, page_size):
+            yield from self._iter_parsed_messages(msg_ids)
+    
+    def _iter_message_id_pages(self, query, page_size=100):
+        """Yieldar en lista med meddelande-ID:n per sida i sökresultatet
+        
+        Fel efter omförsök kastas vidare - en avbruten sökning får inte se ut
+        som en kortare vecka.
+        """
+        page_token = None
+        
+        while True:
             results = self.service.users().messages().list(
                 userId='me',
                 q=query,
-                maxResults=100
-            ).execute()
+                maxResults=page_size,
+                pageToken=page_token
+            ).execute(num_retries=3)
             
-            messages = results.get('messages', [])
-            newsletters = []
+            yield [msg['id'] for msg in results.get('messages', [])]
             
-            for msg in messages:
-                newsletter = self._get_message_details(msg['id'])
-                if newsletter:
-                    newsletters.append(newsletter)
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+    
+    def _iter_parsed_messages(self, msg_ids, unread_only=False, already_read=None):
+        """Hämta och tolka metadata för meddelanden, i samma ordning som msg_ids
+        
+        Bara headers och snippet hämtas här - HTML-body hämtas vid behov via
+        get_html_body(). Meddelanden som redan finns i den lokala cachen hämtas
+        inte från Gmail igen. Med unread_only läggs ID:n för meddelanden som
+        hoppas över för att de redan är lästa till i listan already_read.
+        """
+        cached = self.cache.get_many(msg_ids) if self.cache else {}
+        misses = [msg_id for msg_id in msg_ids if msg_id not in cached]
+        fetched = self._fetch_messages(
+            misses,
+            format='metadata',
+            metadataHeaders=METADATA_HEADERS,
+            fields=METADATA_FIELDS
+        )
+        
+        # Cachen innehåller inte etiketter (de kan ändras) - kolla dem med ett lätt anrop
+        labels = {}
+        if unread_only and cached:
+            labels = self._fetch_messages(list(cached), format='minimal', fields='id,labelIds')
+        
+        for msg_id in msg_ids:
+            if msg_id in cached:
+                if unread_only and 'UNREAD' not in labels.get(msg_id, {}).get('labelIds', []):
+                    # Saknas etiketterna gick anropet fel - då vet vi inte att det är läst
+                    if already_read is not None and msg_id in labels:
+                        already_read.append(msg_id)
+                    continue
+                newsletter = cached.pop(msg_id)
+                newsletter.pop('html_body', None)
+                yield newsletter
+                continue
             
-            return newsletters
+            message = fetched.pop(msg_id, None)
+            if not message:
+                continue
+            if unread_only and 'UNREAD' not in message.get('labelIds', []):
+                if already_read is not None:
+                    already_read.append(msg_id)
+                continue
+            newsletter = self._parse_message(msg_id, message)
+            if newsletter:
+                if self.cache:
+                    self.cache.put(msg_id, newsletter)
+                yield newsletter
+    
+    def get_html_body(self, msg_id):
+        """Hämta HTML-body för ett meddelande (andra fasen - används bara av Drive-steget)"""
+        return self.get_html_bodies([msg_id]).get(msg_id, "")
+    
+    def get_html_bodies(self, msg_ids):
+        """Hämta HTML-body för flera meddelanden - returnerar {msg_id: html}"""
+        return {msg_id: html_body for msg_id, (html_body, _) in self.get_bodies(msg_ids).items()}
+    
+    def get_bodies(self, msg_ids):
+        """Hämta HTML-body och utdragen brödtext för flera meddelanden
+        
+        Returnerar {msg_id: (html, text)}. Texten är rensad från sidfot,
+        avregistreringsblock och spårningslänkar och är det som skickas till Claude.
+        """
+        bodies = {}
+        cached = self.cache.get_many(msg_ids) if self.cache else {}
+        for msg_id, data in cached.items():
+            if 'html_body' in data:
+                # Äldre cacheposter saknar texten - den går att räkna fram ur HTML:en
+                text = data['text'] if 'text' in data else extract_newsletter_text(data['html_body'])
+                bodies[msg_id] = (data['html_body'], text)
+        
+        misses = [msg_id for msg_id in msg_ids if msg_id not in bodies]
+        fetched = self._fetch_messages(misses, format='full', fields=BODY_FIELDS)
+        
+        for msg_id, message in fetched.items():
+            try:
+                html_body, text = self._get_bodies(message['payload'])
+            except Exception as e:
+                print(f"Fel vid tolkning av body för {msg_id}: {e}")
+                continue
+            bodies[msg_id] = (html_body, text)
             
-        except Exception as e:
-            print(f"Fel vid hämtning från Gmail: {e}")
-            return []
+            if self.cache and msg_id in cached:
+                self.cache.put(msg_id, {**cached[msg_id], 'html_body': html_body, 'text': text})
+        
+        return bodies
     
-    def mark_as_read(self, message_ids):
-        """Markera newsletters som lästa efter bearbetning"""
-        try:
-            for msg_id in message_ids:
-                self.service.users().messages().modify(
+    # --- Inkrementell synk via History API ---
+    
+    def sync(self):
+        """Hämta nya newsletters sedan senaste historyId-checkpoint och lägg dem i kö
+        
+        Returnerar antal nya meddelanden. Första gången (eller om checkpointen är för
+        gammal) görs en vanlig sökning från förra veckans start för att fylla kön.
+        """
+        state = self._load_sync_state()
+        pending = state.get('pending_ids', [])
+        known = set(pending)
+        
+        # Läs historyId innan listningen så att inget som kommer in under tiden missas
+        history_id = self.service.users().getProfile(userId='me').execute()['historyId']
+        
+        new_ids = None
+        if state.get('history_id'):
+            new_ids = self._list_history_message_ids(state['history_id'])
+        
+        if new_ids is None:
+            print("Ingen giltig historyId-checkpoint - söker från förra veckans start")
+            # Samma startgräns som iter_newsletters - äldre olästa newsletters ska inte köas
+            start, _ = self.get_last_week_range()
+            query = f'label:{NEWSLETTER_LABEL} after:{start.strftime("%Y/%m/%d")} is:unread'
+            new_ids = [msg_id for page in self._iter_message_id_pages(query) for msg_id in page]
+        
+        added = [msg_id for msg_id in new_ids if msg_id not in known]
+        pending.extend(added)
+        
+        self._save_sync_state({'history_id': history_id, 'pending_ids': pending})
+        
+        # Värm upp cachen så att fredagskörningen inte behöver hämta innehållet
+        if self.cache and added:
+            for start in range(0, len(added), 100):
+                for _ in self._iter_parsed_messages(added[start:start + 100]):
+                    pass
+        
+        print(f"✓ Synk klar: {len(added)} nya newsletters ({len(pending)} i kö)")
+        return len(added)
+    
+    def iter_pending_newsletters(self):
+        """Yieldar köade newsletters som fortfarande är olästa
+        
+        Köade meddelanden som lästs sedan de köades tas bort ur kön.
+        """
+        pending = self._load_sync_state().get('pending_ids', [])
+        already_read = []
+        
+        for start in range(0, len(pending), 100):
+            yield from self._iter_parsed_messages(pending[start:start + 100], unread_only=True, already_read=already_read)
+        
+        if already_read:
+            print(f"{len(already_read)} köade newsletters är redan lästa - tas bort ur kön")
+            self.clear_pending(already_read)
+    
+    def clear_pending(self, message_ids):
+        """Ta bort bearbetade meddelanden från synk-kön"""
+        state = self._load_sync_state()
+        done = set(message_ids)
+        state['pending_ids'] = [m for m in state.get('pending_ids', []) if m not in done]
+        self._save_sync_state(state)
+    
+    def _list_history_message_ids(self, start_history_id):
+        """Lista meddelanden som fått Newsletters-etiketten sedan start_history_id
+        
+        Returnerar None om checkpointen är för gammal (Gmail svarar 404).
+        """
+        label_id = self._get_label_id(NEWSLETTER_LABEL)
+        if not label_id:
+            print(f"Hittade ingen etikett '{NEWSLETTER_LABEL}'")
+            return []
+        
+        msg_ids = []
+        seen = set()
+        page_token = None
+        
+        while True:
+            try:
+                results = self.service.users().history().list(
                     userId='me',
-                    id=msg_id,
-                    body={'removeLabelIds': ['UNREAD']}
+                    startHistoryId=start_history_id,
+                    labelId=label_id,
+                    historyTypes=['messageAdded', 'labelAdded'],
+                    pageToken=page_token
                 ).execute()
-            print(f"✓ Markerade {len(message_ids)} newsletters som lästa")
-        except Exception as e:
-            print(f"Fel vid markering som läst: {e}")
+            except HttpError as e:
+                if e.resp.status == 404:
+                    return None
+                raise
+            
+            for record in results.get('history', []):
+                added = record.get('messagesAdded', []) + record.get('labelsAdded', [])
+                for item in added:
+                    message = item['message']
+                    if label_id not in message.get('labelIds', []):
+                        continue
+                    if message['id'] not in seen:
+                        seen.add(message['id'])
+                        msg_ids.append(message['id'])
+            
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+        
+        return msg_ids
     
-    def _get_message_details(self, msg_id):
-        """Hämta detaljer för ett specifikt meddelande"""
+    def _get_label_id(self, name):
+        """Slå upp ID för en användaretikett"""
+        results = self.service.users().labels().list(userId='me').execute()
+        return next((l['id'] for l in results.get('labels', []) if l['name'] == name), None)
+    
+    def _load_sync_state(self):
+        """Läs synk-state (historyId + kö) från lokal fil"""
         try:
-            message = self.service.users().messages().get(
+            with open(self.sync_state_file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            print(f"Kunde inte läsa synk-state: {e}")
+            return {}
+    
+    def _save_sync_state(self, state):
+        """Spara synk-state atomiskt till lokal fil"""
+        tmp_path = f"{self.sync_state_file}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.sync_state_file)
+    
+    def mark_as_read(self, message_ids, max_retries=2):
+        """Markera newsletters som lästa efter bearbetning via batchModify
+        
+        Returnerar listan med ID:n som inte kunde markeras.
+        """
+        message_ids = list(message_ids)
+        chunks = [
+            message_ids[i:i + BATCH_MODIFY_LIMIT]
+            for i in range(0, len(message_ids), BATCH_MODIFY_LIMIT)
+        ]
+        failed = []
+        
+        for attempt in range(max_retries + 1):
+            failed = []
+            for chunk in chunks:
+                try:
+                    self.service.users().messages().batchModify(
+                        userId='me',
+                        body={'ids': chunk, 'removeLabelIds': ['UNREAD']}
+                    ).execute()
+                    print(f"✓ Markerade {len(chunk)} newsletters som lästa")
+                except Exception as e:
+                    print(f"Fel vid markering av {len(chunk)} newsletters (försök {attempt + 1}): {e}")
+                    failed.append(chunk)
+            
+            # Försök bara igen med de chunks som misslyckades
+            if not failed or attempt == max_retries:
+                break
+            chunks = failed
+            time.sleep(2 ** attempt)
+        
+        unread_ids = [msg_id for chunk in failed for msg_id in chunk]
+        if unread_ids:
+            print(f"Fel: {len(unread_ids)} newsletters är fortfarande olästa: {', '.join(unread_ids)}")
+        
+        return unread_ids
+    
+    def _fetch_messages(self, msg_ids, format='full', **params):
+        """Hämta flera meddelanden enligt fetch_mode - returnerar {msg_id: message}"""
+        if not msg_ids:
+            return {}
+        
+        if self.fetch_mode == 'sequential':
+            messages = {}
+            for msg_id in msg_ids:
+                try:
+                    messages[msg_id] = self.service.users().messages().get(
+                        userId='me',
+                        id=msg_id,
+                        format=format,
+                        **params
+                    ).execute()
+                except Exception as e:
+                    print(f"Fel vid hämtning av meddelande {msg_id}: {e}")
+            return messages
+        
+        if self.fetch_mode == 'threads':
+            return self._fetch_messages_threaded(msg_ids, format, **params)
+        
+        messages, failed = self._fetch_messages_batch(msg_ids, format, **params)
+        
+        # Fallback: hämta misslyckade meddelanden parallellt
+        if failed:
+            print(f"Hämtar {len(failed)} meddelanden igen via trådpool...")
+            messages.update(self._fetch_messages_threaded(failed, format, **params))
+        
+        return messages
+    
+    def _fetch_messages_batch(self, msg_ids, format='full', **params):
+        """Hämta meddelanden via Gmail batch HTTP-anrop - returnerar (messages, failed_ids)"""
+        messages = {}
+        failed = []
+        
+        def callback(request_id, response, exception):
+            # Fel isoleras per meddelande så att resten av batchen klarar sig
+            if exception is not None:
+                print(f"Fel vid batch-hämtning av meddelande {request_id}: {exception}")
+                failed.append(request_id)
+            else:
+                messages[request_id] = response
+        
+        for start in range(0, len(msg_ids), self.batch_size):
+            chunk = msg_ids[start:start + self.batch_size]
+            batch = self.service.new_batch_http_request(callback=callback)
+            
+            for msg_id in chunk:
+                batch.add(
+                    self.service.users().messages().get(
+                        userId='me',
+                        id=msg_id,
+                        format=format,
+                        **params
+                    ),
+                    request_id=msg_id
+                )
+            
+            try:
+                batch.execute()
+            except Exception as e:
+                print(f"Fel vid batch-anrop ({len(chunk)} meddelanden): {e}")
+                failed.extend(m for m in chunk if m not in messages and m not in failed)
+        
+        return messages, failed
+    
+    def _fetch_messages_threaded(self, msg_ids, format='full', **params):
+        """Hämta meddelanden parallellt med begränsat antal trådar"""
+        messages = {}
+        local = threading.local()
+        
+        def fetch(msg_id):
+            # httplib2 är inte trådsäkert - varje tråd får en egen anslutning
+            if not hasattr(local, 'http'):
+                local.http = AuthorizedHttp(self.creds, http=httplib2.Http())
+            return self.service.users().messages().get(
                 userId='me',
                 id=msg_id,
-                format='full'
-            ).execute()
-            
+                format=format,
+                **params
+            ).execute(http=local.http, num_retries=2)
+        
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = {pool.submit(fetch, msg_id): msg_id for msg_id in msg_ids}
+            for future in as_completed(futures):
+                msg_id = futures[future]
+                try:
+                    messages[msg_id] = future.result()
+                except Exception as e:
+                    print(f"Fel vid hämtning av meddelande {msg_id}: {e}")
+        
+        return messages
+    
+    def _parse_message(self, msg_id, message):
+        """Plocka ut headers och snippet från ett hämtat meddelande"""
+        try:
             headers = message['payload']['headers']
             subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'Ingen titel')
             from_email = next((h['value'] for h in headers if h['name'] == 'From'), 'Okänd')
             date = next((h['value'] for h in headers if h['name'] == 'Date'), '')
             
-            # Hämta HTML-body
-            html_body = self._get_html_body(message['payload'])
-            
             return {
                 'id': msg_id,
                 'subject': subject,
                 'from': from_email,
                 'date': date,
-                'html_body': html_body,
                 'snippet': message.get('snippet', '')
             }
             
         except Exception as e:
-            print(f"Fel vid hämtning av meddelande {msg_id}: {e}")
+            print(f"Fel vid tolkning av meddelande {msg_id}: {e}")
             return None
     
-    def _get_html_body(self, payload):
-        """Extrahera HTML-body från meddelande"""
-        if 'parts' in payload:
-            for part in payload['parts']:
-                if part['mimeType'] == 'text/html':
-                    if 'data' in part['body']:
-                        return base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
-                elif 'parts' in part:
-                    # Rekursivt för nested parts
-                    html = self._get_html_body(part)
-                    if html:
-                        return html
-        
-        # Fallback till body direkt
-        if 'body' in payload and 'data' in payload['body']:
-            return base64.urlsafe_b64decode(payload['body']['data']).decode('utf-8')
-        
-        return ""
+    def _get_bodies(self, payload):
+        """Extrahera (HTML-body, brödtext) - text/plain används direkt om HTML saknas"""
+        html_body, text_body = extract_body(payload, max_bytes=self.max_body_bytes)
+        if html_body:
+            return html_body, extract_newsletter_text(html_body)
+        return text_as_html(text_body), (text_body or '').strip()
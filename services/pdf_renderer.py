@@ -0,0 +1,346 @@
+"""PDF Renderer - Renderar HTML till PDF parallellt med async Playwright
+
+Playwrights async-API körs i en egen event loop i en bakgrundstråd, så att
+vanlig synkron kod kan skicka in flera jobb samtidigt. Varje jobb får en egen
+browser context (isolerade cookies/cache) och en egen timeout.
+
+Alla nätverksanrop från sidorna går genom en route-hanterare som blockerar
+kända trackers och serverar bilder, typsnitt och CSS från en lokal disk-cache.
+Väntan på nätverket har en hård budget - därefter renderas sidan som den är.
+
+En renderare kan leva länge (t.ex. ägd av web-appen). Browsern startas då om
+efter max_renders jobb eller när Chromium använder mer än max_memory_mb.
+"""
+
+import asyncio
+import json
+import os
+import threading
+from urllib.parse import urlparse
+from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
+
+# Trackers och analystjänster som aldrig påverkar hur ett nyhetsbrev ser ut
+BLOCKED_DOMAINS = {
+    'google-analytics.com',
+    'googletagmanager.com',
+    'doubleclick.net',
+    'connect.facebook.net',
+    'hotjar.com',
+    'segment.io',
+    'mixpanel.com',
+    'track.hubspot.com',
+    'eotrx.substackcdn.com',
+    'mandrillapp.com',
+    'pixel.wp.com',
+}
+
+# Öppningspixlar från vanliga utskicksverktyg
+BLOCKED_PATH_PARTS = ('/track/open', '/wf/open', '/open.php', '/e/o/')
+
+# Resurstyper som är samma vecka efter vecka och värda att cacha
+CACHEABLE_RESOURCE_TYPES = {'image', 'font', 'stylesheet'}
+
+# Större filer än så här cachas inte
+MAX_ASSET_BYTES = 5 * 1024 * 1024
+
+# Headers som sparas med cachade assets - utan CORS-headers blockeras t.ex. webbtypsnitt
+CACHED_HEADERS = ('content-type', 'access-control-allow-origin', 'access-control-allow-credentials', 'timing-allow-origin')
+
+PDF_OPTIONS = {
+    'format': 'A4',
+    'print_background': True,
+    'margin': {'top': '20px', 'right': '20px', 'bottom': '20px', 'left': '20px'}
+}
+
+
+def is_blocked_url(url, blocked_domains=BLOCKED_DOMAINS):
+    """Är URL:en en känd tracker eller öppningspixel?"""
+    parsed = urlparse(url)
+    if parsed.scheme not in ('http', 'https'):
+        return False
+
+    host = (parsed.hostname or '').lower()
+    if any(host == domain or host.endswith('.' + domain) for domain in blocked_domains):
+        return True
+
+    path = parsed.path.lower()
+    return any(part in path for part in BLOCKED_PATH_PARTS)
+
+
+class PdfRenderer:
+    def __init__(self, concurrency=4, timeout=30, network_budget=5, asset_cache=None, blocked_domains=(),
+                 max_renders=200, max_memory_mb=1024):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.network_budget = network_budget
+        self.asset_cache = asset_cache
+        self.blocked_domains = BLOCKED_DOMAINS | set(blocked_domains)
+        self.max_renders = max_renders
+        self.max_memory_mb = max_memory_mb
+        self.loop = None
+        self.thread = None
+        self.playwright = None
+        self.browser = None
+        self.semaphore = None
+        self.renders = 0
+        self.restarts = 0
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.render_lock = threading.Lock()
+        self.counter_lock = threading.Lock()
+
+    def submit_many(self, html_bodies):
+        """Starta rendering av flera HTML-dokument - returnerar en Future per dokument
+
+        Futures blir klara i den ordning renderingarna blir färdiga, så att
+        anroparen kan börja ladda upp innan hela gruppen är renderad.
+        """
+        if not html_bodies:
+            return []
+        self._ensure_started()
+        with self.render_lock:
+            # Starta bara om browsern när inga jobb pågår
+            if self.in_flight == 0:
+                self._recycle_if_needed()
+            futures = [
+                asyncio.run_coroutine_threadsafe(self._render_with_timeout(html_body), self.loop)
+                for html_body in html_bodies
+            ]
+            self.renders += len(html_bodies)
+            with self.counter_lock:
+                self.in_flight += len(html_bodies)
+
+        for future in futures:
+            future.add_done_callback(self._job_done)
+        return futures
+
+    def render_many(self, html_bodies):
+        """Rendera flera HTML-dokument - returnerar PDF-bytes eller Exception per dokument"""
+        results = []
+        for future in self.submit_many(html_bodies):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def warm(self):
+        """Starta browsern i förväg så att första körningen slipper uppstartstiden"""
+        self._ensure_started()
+
+    def health(self):
+        """Status för renderaren - startar om browsern om den tappat anslutningen"""
+        if not self.loop:
+            return {'status': 'stopped', 'renders': self.renders, 'restarts': self.restarts}
+
+        with self.render_lock:
+            connected = self.browser is not None and self.browser.is_connected()
+            if not connected:
+                print("PDF-renderarens browser svarar inte - startar om")
+                self._restart_browser()
+
+        return {
+            'status': 'ok' if connected else 'restarted',
+            'renders': self.renders,
+            'restarts': self.restarts,
+            'memory_mb': self._browser_memory_mb()
+        }
+
+    def _job_done(self, future):
+        # Körs i event loop-tråden - egen lås så att close() inte kan blockera den
+        with self.counter_lock:
+            self.in_flight -= 1
+
+    def render(self, html_body):
+        """Rendera ett HTML-dokument till PDF-bytes"""
+        result = self.render_many([html_body])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def close(self):
+        """Stäng browser, Playwright och event loop"""
+        with self.lock:
+            if not self.loop:
+                return
+            try:
+                asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result(timeout=30)
+            except Exception as e:
+                print(f"Fel vid stängning av PDF-renderare: {e}")
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(timeout=10)
+            self.loop = None
+            self.thread = None
+
+    def _recycle_if_needed(self):
+        """Starta om browsern efter max_renders jobb eller vid för hög minnesanvändning"""
+        memory_mb = self._browser_memory_mb()
+        if self.renders >= self.max_renders:
+            print(f"PDF-renderaren har gjort {self.renders} renderingar - startar om browsern")
+        elif memory_mb is not None and memory_mb > self.max_memory_mb:
+            print(f"PDF-renderarens browser använder {memory_mb:.0f} MB - startar om")
+        else:
+            return
+        self._restart_browser()
+
+    def _restart_browser(self):
+        asyncio.run_coroutine_threadsafe(self._relaunch_browser(), self.loop).result(timeout=60)
+        self.renders = 0
+        self.restarts += 1
+
+    def _browser_memory_mb(self):
+        """Summerat RSS för alla barnprocesser (Playwright-driver + Chromium), None om okänt"""
+        try:
+            children = {}
+            for pid in os.listdir('/proc'):
+                if not pid.isdigit():
+                    continue
+                try:
+                    with open(f'/proc/{pid}/stat') as f:
+                        # Fält 4 är ppid, räknat efter processnamnet inom parentes
+                        ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+                except (OSError, IndexError, ValueError):
+                    continue
+                children.setdefault(ppid, []).append(int(pid))
+
+            total_kb = 0
+            stack = list(children.get(os.getpid(), []))
+            while stack:
+                pid = stack.pop()
+                stack.extend(children.get(pid, []))
+                try:
+                    with open(f'/proc/{pid}/status') as f:
+                        for line in f:
+                            if line.startswith('VmRSS:'):
+                                total_kb += int(line.split()[1])
+                                break
+                except OSError:
+                    continue
+            return total_kb / 1024
+        except OSError:
+            return None
+
+    def _ensure_started(self):
+        """Starta event loop-tråden och browsern första gången de behövs"""
+        with self.lock:
+            if self.loop:
+                return
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name='pdf-renderer', daemon=True)
+            thread.start()
+            try:
+                asyncio.run_coroutine_threadsafe(self._start_browser(), loop).result()
+            except Exception:
+                # Misslyckad start - städa upp så att nästa anrop försöker igen
+                try:
+                    asyncio.run_coroutine_threadsafe(self._shutdown(), loop).result(timeout=30)
+                except Exception as e:
+                    print(f"Fel vid stängning efter misslyckad start: {e}")
+                loop.call_soon_threadsafe(loop.stop)
+                thread.join(timeout=10)
+                loop.close()
+                raise
+            self.loop = loop
+            self.thread = thread
+
+    async def _start_browser(self):
+        # Semaforen skapas först och oberoende av browsern - den behövs även efter omstart
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.playwright = await async_playwright().start()
+        await self._launch_browser()
+
+    async def _launch_browser(self):
+        self.browser = await self.playwright.chromium.launch(
+            headless=True,
+            args=['--no-sandbox', '--disable-setuid-sandbox']
+        )
+
+    async def _relaunch_browser(self):
+        if self.browser:
+            try:
+                await self.browser.close()
+            except Exception as e:
+                print(f"Fel vid stängning av browser: {e}")
+        await self._launch_browser()
+
+    async def _shutdown(self):
+        if self.browser:
+            await self.browser.close()
+            self.browser = None
+        if self.playwright:
+            await self.playwright.stop()
+            self.playwright = None
+
+    async def _render_with_timeout(self, html_body):
+        async with self.semaphore:
+            return await asyncio.wait_for(self._render_one(html_body), timeout=self.timeout)
+
+    async def _render_one(self, html_body):
+        context = await self.browser.new_context()
+        try:
+            await context.route('**/*', self._handle_route)
+            page = await context.new_page()
+            await page.set_content(html_body, wait_until='load', timeout=self.timeout * 1000)
+
+            # Hård budget för resterande nätverksanrop - rendera det som hunnit laddas
+            try:
+                await page.wait_for_load_state('networkidle', timeout=self.network_budget * 1000)
+            except PlaywrightTimeoutError:
+                pass
+
+            return await page.pdf(**PDF_OPTIONS)
+        finally:
+            await context.close()
+
+    async def _handle_route(self, route):
+        """Blockera trackers och servera cachade assets"""
+        request = route.request
+        url = request.url
+
+        if self._is_blocked(url):
+            await route.abort()
+            return
+
+        if not self.asset_cache or request.method != 'GET' or request.resource_type not in CACHEABLE_RESOURCE_TYPES:
+            await route.continue_()
+            return
+
+        # SQLite-anropen blockerar - kör dem i en tråd så att andra renderingar inte väntar på disken
+        cached = unpack_asset(await asyncio.to_thread(self.asset_cache.get, url))
+        if cached is not None:
+            headers, body = cached
+            await route.fulfill(status=200, body=body, headers=headers)
+            return
+
+        try:
+            response = await route.fetch(timeout=self.network_budget * 1000)
+            body = await response.body()
+        except Exception:
+            await route.abort()
+            return
+
+        if response.status == 200 and len(body) <= MAX_ASSET_BYTES:
+            await asyncio.to_thread(self.asset_cache.put, url, pack_asset(response.headers, body))
+
+        await route.fulfill(response=response, body=body)
+
+    def _is_blocked(self, url):
+        return is_blocked_url(url, self.blocked_domains)
+
+
+def pack_asset(headers, body):
+    """Cachepost för asset-cachen: headers som behövs vid uppspelning (JSON på första raden) + innehållet"""
+    kept = {name: headers[name] for name in CACHED_HEADERS if name in headers}
+    kept.setdefault('content-type', 'application/octet-stream')
+    return json.dumps(kept).encode() + b'\n' + body
+
+
+def unpack_asset(cached):
+    """(headers, body) ur en cachad asset, None om den saknas"""
+    if cached is None:
+        return None
+    first_line, _, body = cached.partition(b'\n')
+    if not first_line.startswith(b'{'):
+        # Äldre poster sparade bara content-type (utan CORS-headers) - hämtas om
+        return None
+    return json.loads(first_line), body
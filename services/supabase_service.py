@@ -27,7 +27,8 @@ class SupabaseService:
                 'created_at': datetime.now().isoformat(),
                 'markdown_content': markdown_content,
                 'status': 'completed',
-                'newsletter_count': len(newsletters)
+                'newsletter_count': len(newsletters),
+                'youtube_picks': youtube_picks
             }
             
             if existing.data:
@@ -8,9 +8,13 @@ CREATE TABLE IF NOT EXISTS weekly_summaries (
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
     markdown_content TEXT NOT NULL,
     status TEXT DEFAULT 'completed',
-    newsletter_count INTEGER DEFAULT 0
+    newsletter_count INTEGER DEFAULT 0,
+    youtube_picks BIGINT[] DEFAULT '{}'
 );
 
+-- Befintliga databaser: lägg till kolumnen för valda YouTube-videos
+ALTER TABLE weekly_summaries ADD COLUMN IF NOT EXISTS youtube_picks BIGINT[] DEFAULT '{}';
+
 -- Tabell för individuella newsletters
 CREATE TABLE IF NOT EXISTS newsletters (
     id BIGSERIAL PRIMARY KEY,
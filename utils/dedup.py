@@ -0,0 +1,163 @@
+"""Dubblettsökning - grupperar newsletters som handlar om samma sak
+
+Flera newsletters täcker ofta samma lansering samma vecka. För att inte skicka
+samma text till Claude flera gånger görs två saker:
+
+1. Nästan identiska newsletters (ämne + brödtext) grupperas och bara en
+   representant skickas, med Drive-länkarna för alla källor.
+2. Stycken (nyheter) som upprepas i flera newsletters tas bara med första gången.
+
+Likheten skattas med MinHash (bottom-k-varianten: en hash per shingle, de k
+minsta sparas) över ord-shingles. Kandidatpar hittas via ett inverterat index
+på sketch-värdena, så bara par som delar minst ett värde jämförs.
+"""
+
+import re
+from hashlib import blake2b
+
+WORD_RE = re.compile(r'\w+')
+# Länkmål i Markdown säger inget om innehållet
+LINK_TARGET_RE = re.compile(r'\]\(https?://[^)]*\)')
+
+SKETCH_SIZE = 64
+SHINGLE_WORDS = 3
+# Bara de minsta värdena i varje sketch indexeras - liknande texter delar dem med hög sannolikhet
+INDEX_SIZE = 8
+
+# Kortare stycken än så här (rubriker, "Läs mer" osv.) jämförs inte
+MIN_STORY_WORDS = 20
+
+
+def merge_near_duplicates(newsletters, threshold=0.5, story_threshold=0.6):
+    """Slå ihop nästan identiska newsletters och ta bort upprepade stycken
+
+    Returnerar (representanter, statistik). Varje representant är en kopia av
+    det newsletter i gruppen som har längst text, med 'duplicates' (övriga
+    källor i gruppen) och 'text' utan stycken som redan förekommit tidigare.
+    """
+    # Shingles per stycke räknas en gång och återanvänds för hela newsletters
+    paragraphs = [_paragraph_shingles(nl.get('text') or nl['snippet']) for nl in newsletters]
+    clusters = _cluster([
+        _sketch(_shingles(nl['subject']).union(*(shingles for _, shingles in paragraphs[i])))
+        for i, nl in enumerate(newsletters)
+    ], threshold)
+
+    representatives = []
+    representative_paragraphs = []
+    for cluster in clusters:
+        best = max(cluster, key=lambda i: len(newsletters[i].get('text') or newsletters[i]['snippet']))
+        representative = dict(newsletters[best])
+        representative['duplicates'] = [newsletters[i] for i in cluster if i != best]
+        representatives.append(representative)
+        # Upprepade stycken tas bara bort ur 'text' - snippet-fallbacken jämförs inte
+        representative_paragraphs.append(paragraphs[best] if newsletters[best].get('text') else [])
+
+    removed_stories = _remove_repeated_stories(representatives, representative_paragraphs, story_threshold)
+
+    stats = {
+        'newsletters': len(newsletters),
+        'clusters': len(representatives),
+        'merged': len(newsletters) - len(representatives),
+        'removed_stories': removed_stories
+    }
+    return representatives, stats
+
+
+def _cluster(sketches, threshold):
+    """Union-find över alla par med likhet >= threshold"""
+    parent = list(range(len(sketches)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for a, b in _similar_pairs(sketches, threshold):
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    clusters = {}
+    for i in range(len(sketches)):
+        clusters.setdefault(find(i), []).append(i)
+    return list(clusters.values())
+
+
+def _remove_repeated_stories(newsletters, paragraphs, threshold):
+    """Ta bort stycken som liknar ett stycke i ett tidigare newsletter - returnerar antal borttagna"""
+    stories = []
+    for index, newsletter_paragraphs in enumerate(paragraphs):
+        for paragraph, shingles in newsletter_paragraphs:
+            if len(shingles) >= MIN_STORY_WORDS:
+                stories.append((index, paragraph, _sketch(shingles)))
+
+    repeated = set()
+    for a, b in _similar_pairs([sketch for _, _, sketch in stories], threshold):
+        # Paren kommer i ordning (a < b) - behåll första förekomsten
+        if stories[a][0] != stories[b][0] and a not in repeated:
+            repeated.add(b)
+
+    if not repeated:
+        return 0
+
+    dropped = {}
+    for story in repeated:
+        index, paragraph, _ = stories[story]
+        dropped.setdefault(index, set()).add(paragraph)
+    for index, removed in dropped.items():
+        text = newsletters[index]['text']
+        newsletters[index]['text'] = '\n\n'.join(p for p in text.split('\n\n') if p not in removed)
+    return len(repeated)
+
+
+def _paragraph_shingles(text):
+    """[(stycke, shingles)] för varje stycke i texten"""
+    return [(paragraph, _shingles(paragraph)) for paragraph in text.split('\n\n')]
+
+
+def _shingles(text):
+    """Mängd med hashade ord-shingles"""
+    words = WORD_RE.findall(LINK_TARGET_RE.sub(']', text).lower())
+    if len(words) < SHINGLE_WORDS:
+        grams = words
+    else:
+        grams = map(' '.join, zip(*(words[i:] for i in range(SHINGLE_WORDS))))
+    # Stabil hash (inte hash(), som slumpas per process) så att grupperingen blir reproducerbar
+    return {int.from_bytes(blake2b(gram.encode(), digest_size=8).digest(), 'big') for gram in grams}
+
+
+def _sketch(shingles):
+    """Bottom-k MinHash: de SKETCH_SIZE minsta hasharna, sorterade"""
+    return tuple(sorted(shingles)[:SKETCH_SIZE])
+
+
+def _similarity(a, b):
+    """Skatta Jaccard-likheten från två bottom-k-sketcher"""
+    if a == b:
+        # Vanligt fall: samma stycke ordagrant i flera newsletters
+        return 1.0
+    shared = set(a).intersection(b)
+    if not shared:
+        return 0.0
+    union = sorted(shared.union(a, b))[:SKETCH_SIZE]
+    return len(shared.intersection(union)) / len(union)
+
+
+def _similar_pairs(sketches, threshold):
+    """Par (a, b) med a < b vars skattade likhet är minst threshold"""
+    index = {}
+    for i, sketch in enumerate(sketches):
+        for h in sketch[:INDEX_SIZE]:
+            index.setdefault(h, []).append(i)
+
+    candidates = set()
+    for members in index.values():
+        for x in range(len(members)):
+            for y in range(x + 1, len(members)):
+                candidates.add((members[x], members[y]))
+
+    return sorted(
+        (a, b) for a, b in candidates
+        if _similarity(sketches[a], sketches[b]) >= threshold
+    )
@@ -0,0 +1,95 @@
+"""Disk-cache - nyckel/värde-lagring i SQLite med storleksbegränsad LRU-rensning
+
+Används som grund för meddelandecachen och asset-cachen vid PDF-rendering.
+Värden är bytes; poster som inte använts på längst tid tas bort först när
+cachen blir större än max_bytes.
+"""
+
+import sqlite3
+import threading
+import time
+
+
+class DiskCache:
+    def __init__(self, path, max_bytes=200 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            'key TEXT PRIMARY KEY, data BLOB NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_entries_accessed ON entries(accessed)')
+        self.conn.commit()
+        # Löpande total storlek - put() ska inte behöva summera hela tabellen
+        self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def get(self, key):
+        """Hämta ett cachat värde, eller None"""
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """Hämta flera cachade värden - returnerar {key: bytes}"""
+        if not keys:
+            return {}
+
+        found = {}
+        with self.lock:
+            # SQLite har en gräns för antal parametrar per fråga
+            for start in range(0, len(keys), 500):
+                chunk = list(keys[start:start + 500])
+                placeholders = ','.join('?' * len(chunk))
+                rows = self.conn.execute(
+                    f'SELECT key, data FROM entries WHERE key IN ({placeholders})', chunk
+                ).fetchall()
+                found.update(rows)
+
+            if found:
+                now = time.time()
+                self.conn.executemany(
+                    'UPDATE entries SET accessed = ? WHERE key = ?',
+                    [(now, key) for key in found]
+                )
+                self.conn.commit()
+
+        return found
+
+    def put(self, key, data):
+        """Spara ett värde och rensa äldsta poster om cachen blivit för stor"""
+        with self.lock:
+            replaced = self._size_of(key)
+            self.conn.execute(
+                'INSERT OR REPLACE INTO entries (key, data, size, accessed) VALUES (?, ?, ?, ?)',
+                (key, data, len(data), time.time())
+            )
+            self.total_bytes += len(data) - replaced
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+            self.conn.commit()
+
+    def delete(self, key):
+        with self.lock:
+            self.total_bytes -= self._size_of(key)
+            self.conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+            self.conn.commit()
+
+    def _size_of(self, key):
+        row = self.conn.execute('SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else 0
+
+    def _evict(self):
+        """Ta bort minst nyligen använda poster tills cachen ryms i max_bytes"""
+        to_delete = []
+        rows = self.conn.execute('SELECT key, size FROM entries ORDER BY accessed')
+        for key, size in rows:
+            if self.total_bytes <= self.max_bytes:
+                break
+            to_delete.append((key,))
+            self.total_bytes -= size
+
+        self.conn.executemany('DELETE FROM entries WHERE key = ?', to_delete)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,130 @@
+"""Självbärande HTML-arkiv - sanerar newsletter-HTML utan browser
+
+Tar bort script, iframes, event-attribut och spårningspixlar. Bilder kan
+bäddas in som nedskalade data-URI:er så att filen går att läsa offline.
+"""
+
+import base64
+import html
+from io import BytesIO
+from html.parser import HTMLParser
+from PIL import Image
+
+REMOVED_TAGS = {'script', 'iframe', 'object', 'embed', 'frame', 'frameset', 'noscript', 'form'}
+VOID_TAGS = {'area', 'base', 'br', 'col', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+URL_ATTRS = {'href', 'src', 'action', 'background', 'poster'}
+
+
+class _Sanitizer(HTMLParser):
+    def __init__(self, inline_image=None):
+        super().__init__(convert_charrefs=True)
+        self.inline_image = inline_image
+        self.out = []
+        self.skip_depth = 0
+
+    def handle_decl(self, decl):
+        if decl.lower().startswith('doctype'):
+            self.out.append(f'<!{decl}>')
+
+    def handle_starttag(self, tag, attrs):
+        self._start(tag, attrs, self_closing=False)
+
+    def handle_startendtag(self, tag, attrs):
+        self._start(tag, attrs, self_closing=True)
+
+    def _start(self, tag, attrs, self_closing):
+        if tag in REMOVED_TAGS:
+            if not self_closing and tag not in VOID_TAGS:
+                self.skip_depth += 1
+            return
+        if self.skip_depth:
+            return
+
+        attrs = dict(attrs)
+
+        # Externa resurser som laddas automatiskt (t.ex. typsnitt) behövs inte
+        if tag == 'link' or (tag == 'meta' and (attrs.get('http-equiv') or '').lower() == 'refresh'):
+            return
+
+        if tag == 'img':
+            if _is_tracking_pixel(attrs):
+                return
+            src = attrs.get('src') or ''
+            if self.inline_image and src.startswith(('http://', 'https://')):
+                data_uri = self.inline_image(src)
+                if data_uri is None:
+                    return
+                attrs['src'] = data_uri
+            attrs.pop('srcset', None)
+
+        clean = []
+        for name, value in attrs.items():
+            if name.startswith('on') or value is None:
+                continue
+            if name in URL_ATTRS and value.strip().lower().startswith(('javascript:', 'vbscript:')):
+                continue
+            clean.append(f' {name}="{html.escape(value, quote=True)}"')
+
+        self.out.append(f"<{tag}{''.join(clean)}{' /' if self_closing else ''}>")
+
+    def handle_endtag(self, tag):
+        if tag in REMOVED_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+            return
+        if self.skip_depth or tag in VOID_TAGS:
+            return
+        self.out.append(f'</{tag}>')
+
+    def handle_data(self, data):
+        if self.skip_depth:
+            return
+        # Innehåll i <style> är CSS och ska inte HTML-escapas
+        self.out.append(data if self.cdata_elem else html.escape(data, quote=False))
+
+
+def sanitize_html(html_body, inline_image=None):
+    """Sanera HTML - inline_image(url) returnerar data-URI, eller None för att ta bort bilden"""
+    parser = _Sanitizer(inline_image)
+    parser.feed(html_body or '')
+    parser.close()
+    return ''.join(parser.out)
+
+
+def image_urls(html_body):
+    """Externa bild-URL:er som sanitize_html() skulle bädda in, i dokumentordning"""
+    urls = []
+
+    def collect(url):
+        urls.append(url)
+        return None
+
+    sanitize_html(html_body, inline_image=collect)
+    return list(dict.fromkeys(urls))
+
+
+def downscale_image(data, max_width=800, quality=70):
+    """Skala ner och komprimera en bild - returnerar (bytes, mimetype)"""
+    image = Image.open(BytesIO(data))
+
+    if image.width > max_width:
+        height = round(image.height * max_width / image.width)
+        image = image.resize((max_width, height), Image.LANCZOS)
+
+    out = BytesIO()
+    # Behåll PNG för bilder med transparens (logotyper), annars JPEG
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image.save(out, format='PNG', optimize=True)
+        return out.getvalue(), 'image/png'
+
+    image.convert('RGB').save(out, format='JPEG', quality=quality, optimize=True)
+    return out.getvalue(), 'image/jpeg'
+
+
+def to_data_uri(data, mimetype):
+    return f"data:{mimetype};base64,{base64.b64encode(data).decode('ascii')}"
+
+
+def _is_tracking_pixel(attrs):
+    width = (attrs.get('width') or '').strip().rstrip('px')
+    height = (attrs.get('height') or '').strip().rstrip('px')
+    return width in ('0', '1') and height in ('0', '1')
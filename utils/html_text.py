@@ -0,0 +1,243 @@
+"""HTML till Markdown/text - enkel extraktion utan browser
+
+Behåller rubriker, stycken, listor och länkar (som Markdown-länkar) och
+hoppar över script, style och annat som inte syns.
+
+extract_newsletter_text() är varianten för Claude: den tar dessutom bort
+dolda preheaders, sidhuvud/sidfot, avregistreringsblock och spårningslänkar
+så att varje token är innehåll.
+"""
+
+import re
+from html.parser import HTMLParser
+from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
+
+SKIP_TAGS = {'script', 'style', 'head', 'title', 'noscript', 'template', 'svg'}
+BLOCK_TAGS = {'p', 'div', 'section', 'article', 'table', 'tr', 'blockquote', 'center', 'ul', 'ol'}
+HEADING_TAGS = {'h1': 1, 'h2': 2, 'h3': 3, 'h4': 4, 'h5': 5, 'h6': 6}
+VOID_TAGS = {'area', 'base', 'br', 'col', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+
+# Element som aldrig är innehåll: dolda preheaders, sidfötter, sociala länkar
+BOILERPLATE_ATTR_RE = re.compile(r'preheader|preview-?text|footer|unsub|social', re.IGNORECASE)
+HIDDEN_STYLE_RE = re.compile(
+    r'display\s*:\s*none|visibility\s*:\s*hidden|max-height\s*:\s*0(?![.\d])|mso-hide\s*:\s*all',
+    re.IGNORECASE
+)
+
+# Utskicksverktygets fraser - ett stycke räknas som boilerplate bara om det nästan
+# helt består av dem, eller om det är kort och ligger i mailets sista del
+BOILERPLATE_TEXT_RE = re.compile(
+    r'unsubscribe|avregistrera|avsluta (din )?prenumeration|manage (your )?(preferences|subscription)'
+    r'|update your preferences|email preferences|view (this )?(email )?(in|on) (your |the )?(browser|web)'
+    r'|visa (i|på) webbl\w*|read (it )?online|you(\'re| are) receiving this|you received this'
+    r'|this email was sent to|forward(ed)? (this )?(email )?to a friend|was this (email )?forwarded to you'
+    r'|all rights reserved|alla rättigheter|privacy policy|follow us on|©',
+    re.IGNORECASE
+)
+# Stycken där resten av mailet räknas som sidfot
+FOOTER_START_RE = re.compile(r'unsubscribe|avregistrera|avsluta (din )?prenumeration', re.IGNORECASE)
+MAX_BOILERPLATE_CHARS = 300
+# Ord som får bli kvar när fraserna tagits bort ("Unsubscribe here", "Follow us on X")
+MAX_BOILERPLATE_LEFTOVER_WORDS = 2
+# Andel av styckena från slutet som räknas som sidfot
+FOOTER_REGION = 0.25
+MARKDOWN_LINK_RE = re.compile(r'\[([^\]]*)\]\([^)]*\)')
+
+# Klickspårning: omdirigerings-URL:er ger inget för läsaren, bara tokens.
+# Domänerna matchar exakt eller som underdomän, aldrig som prefix.
+TRACKING_DOMAINS = (
+    'list-manage.com', 'sendgrid.net', 'mailchi.mp', 'hubspotlinks.com', 'convertkit-mail.com',
+    'convertkit-mail2.com', 'mandrillapp.com', 'rs6.net', 'awstrack.me', 'mlsend.com', 'sparkpostmail.com'
+)
+# Omdirigeringar som känns igen på domän + sökväg
+TRACKING_PATHS = (('beehiiv.com', '/ss/c'), ('substack.com', '/redirect/'))
+TRACKING_PARAMS = {'ref', 'ref_src', 'mc_cid', 'mc_eid', 'mkt_tok', '_hsenc', '_hsmi'}
+TRACKING_PARAM_PREFIXES = ('utm_',)
+MAX_LINK_CHARS = 120
+
+
+class _MarkdownParser(HTMLParser):
+    def __init__(self, keep_links=True, strip_boilerplate=False):
+        super().__init__(convert_charrefs=True)
+        self.keep_links = keep_links
+        self.strip_boilerplate = strip_boilerplate
+        self.parts = []
+        self.skip_depth = 0
+        self.link_href = None
+        self.link_text = []
+        # Dolt element som hoppas över: (tagg, nästlingsdjup)
+        self.hidden_tag = None
+        self.hidden_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if self.hidden_tag:
+            if tag == self.hidden_tag:
+                self.hidden_depth += 1
+            return
+        if tag in SKIP_TAGS:
+            self.skip_depth += 1
+            return
+        if self.skip_depth:
+            return
+
+        if self.strip_boilerplate and tag not in VOID_TAGS and _is_boilerplate_element(dict(attrs)):
+            self.hidden_tag = tag
+            self.hidden_depth = 1
+            return
+
+        if tag in HEADING_TAGS:
+            self.parts.append('\n\n' + '#' * HEADING_TAGS[tag] + ' ')
+        elif tag in BLOCK_TAGS:
+            self.parts.append('\n\n')
+        elif tag == 'br':
+            self.parts.append('\n')
+        elif tag == 'li':
+            self.parts.append('\n- ')
+        elif tag == 'a' and self.keep_links:
+            href = dict(attrs).get('href') or ''
+            if self.strip_boilerplate:
+                href = _clean_link(href)
+            if href.startswith(('http://', 'https://')):
+                self.link_href = href
+                self.link_text = []
+
+    def handle_endtag(self, tag):
+        if self.hidden_tag:
+            if tag == self.hidden_tag:
+                self.hidden_depth -= 1
+                if self.hidden_depth == 0:
+                    self.hidden_tag = None
+            return
+        if tag in SKIP_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+            return
+        if self.skip_depth:
+            return
+
+        if tag in HEADING_TAGS or tag in BLOCK_TAGS:
+            self.parts.append('\n\n')
+        elif tag == 'a' and self.link_href is not None:
+            text = ' '.join(''.join(self.link_text).split())
+            if text:
+                self.parts.append(f'[{text}]({self.link_href})')
+            self.link_href = None
+
+    def handle_data(self, data):
+        if self.skip_depth or self.hidden_tag:
+            return
+        # Radbrytningar i HTML-källan är bara whitespace
+        data = re.sub(r'\s+', ' ', data)
+        if self.link_href is not None:
+            self.link_text.append(data)
+        else:
+            self.parts.append(data)
+
+
+def html_to_markdown(html_body):
+    """Konvertera HTML till läsbar Markdown"""
+    if not html_body:
+        return ""
+    parser = _MarkdownParser(keep_links=True)
+    parser.feed(html_body)
+    parser.close()
+    return _clean_whitespace(''.join(parser.parts))
+
+
+def html_to_text(html_body):
+    """Konvertera HTML till ren text (utan länkar)"""
+    if not html_body:
+        return ""
+    parser = _MarkdownParser(keep_links=False)
+    parser.feed(html_body)
+    parser.close()
+    return _clean_whitespace(''.join(parser.parts))
+
+
+def extract_newsletter_text(html_body, keep_links=True):
+    """Extrahera innehållet i ett newsletter som kompakt Markdown
+
+    Som html_to_markdown, men utan dolda element, sidfot, avregistreringsblock
+    och spårningslänkar (länktexten behålls). Om rensningen tar bort nästan allt
+    (t.ex. trasig HTML där en sidfot aldrig stängs) används den orensade texten.
+    """
+    if not html_body:
+        return ""
+    parser = _MarkdownParser(keep_links=keep_links, strip_boilerplate=True)
+    parser.feed(html_body)
+    parser.close()
+    text = _strip_boilerplate_paragraphs(_clean_whitespace(''.join(parser.parts)))
+
+    # Jämför bara med den orensade texten när resultatet ser misstänkt kort ut
+    if len(text) < len(html_body) * 0.02:
+        fallback = html_to_markdown(html_body) if keep_links else html_to_text(html_body)
+        if len(text) < len(fallback) * 0.2:
+            return fallback
+    return text
+
+
+def _is_boilerplate_element(attrs):
+    marker = f"{attrs.get('class') or ''} {attrs.get('id') or ''}"
+    if BOILERPLATE_ATTR_RE.search(marker):
+        return True
+    return bool(HIDDEN_STYLE_RE.search(attrs.get('style') or '')) or 'hidden' in attrs or attrs.get('aria-hidden') == 'true'
+
+
+def _clean_link(href):
+    """Ta bort spårningsparametrar - klickspårade och långa länkar blir '' (bara länktexten behålls)"""
+    parsed = urlparse(href)
+    if parsed.scheme not in ('http', 'https'):
+        return ''
+
+    host = (parsed.hostname or '').lower()
+    path = parsed.path.lower()
+    if any(_in_domain(host, domain) for domain in TRACKING_DOMAINS):
+        return ''
+    if any(_in_domain(host, domain) and path.startswith(prefix) for domain, prefix in TRACKING_PATHS):
+        return ''
+
+    query = [(k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True)
+             if not _is_tracking_param(k.lower())]
+    cleaned = urlunparse(parsed._replace(query=urlencode(query), fragment=''))
+    return cleaned if len(cleaned) <= MAX_LINK_CHARS else ''
+
+
+def _in_domain(host, domain):
+    return host == domain or host.endswith('.' + domain)
+
+
+def _is_tracking_param(name):
+    return name in TRACKING_PARAMS or name.startswith(TRACKING_PARAM_PREFIXES)
+
+
+def _strip_boilerplate_paragraphs(text):
+    """Ta bort boilerplate-stycken, och allt efter avregistreringen i andra halvan"""
+    paragraphs = text.split('\n\n')
+    footer_start = len(paragraphs) * (1 - FOOTER_REGION)
+    kept = []
+    for index, paragraph in enumerate(paragraphs):
+        if len(paragraph) > MAX_BOILERPLATE_CHARS:
+            kept.append(paragraph)
+            continue
+        if FOOTER_START_RE.search(paragraph) and index >= len(paragraphs) / 2:
+            break
+        if not BOILERPLATE_TEXT_RE.search(paragraph):
+            kept.append(paragraph)
+        elif index < footer_start and not _is_only_boilerplate(paragraph):
+            # En nyhet som bara nämner t.ex. "privacy policy" är innehåll
+            kept.append(paragraph)
+    return '\n\n'.join(kept)
+
+
+def _is_only_boilerplate(paragraph):
+    """Om stycket i stort sett bara består av utskicksverktygets fraser"""
+    leftover = BOILERPLATE_TEXT_RE.sub(' ', MARKDOWN_LINK_RE.sub(r'\1', paragraph))
+    return len(re.findall(r'[^\W\d_]+', leftover)) <= MAX_BOILERPLATE_LEFTOVER_WORDS
+
+
+def _clean_whitespace(text):
+    # Slå ihop mellanslag per rad, och max en tom rad i följd
+    lines = [' '.join(line.split()) for line in text.split('\n')]
+    text = '\n'.join(lines)
+    # Tomma rubriker och listpunkter
+    text = re.sub(r'^(#+|-)$', '', text, flags=re.MULTILINE)
+    return re.sub(r'\n{3,}', '\n\n', text).strip()
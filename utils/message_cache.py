@@ -0,0 +1,28 @@
+"""Lokal meddelandecache - sparar tolkade Gmail-meddelanden på disk
+
+Gmail-meddelanden ändras aldrig, så innehållet kan cachas per meddelande-ID.
+Data sparas som zlib-komprimerad JSON i en DiskCache och rensas enligt LRU
+när cachen blir större än max_bytes.
+"""
+
+import json
+import zlib
+
+from utils.disk_cache import DiskCache
+
+
+class MessageCache(DiskCache):
+    def get_many(self, msg_ids):
+        """Hämta flera cachade meddelanden - returnerar {msg_id: data}"""
+        found = {}
+        for msg_id, blob in super().get_many(msg_ids).items():
+            try:
+                found[msg_id] = json.loads(zlib.decompress(blob))
+            except Exception as e:
+                print(f"Trasig cachepost för {msg_id}: {e}")
+        return found
+
+    def put(self, msg_id, data):
+        """Spara ett tolkat meddelande"""
+        blob = zlib.compress(json.dumps(data, ensure_ascii=False).encode('utf-8'))
+        super().put(msg_id, blob)
@@ -0,0 +1,95 @@
+"""MIME body-extraktion för Gmail API-payloads
+
+Går igenom MIME-trädet iterativt och avkodar bara den första text/html- och
+text/plain-delen. Bilagor och inline-bilder avkodas aldrig, och stora bodies
+skärs av innan base64-avkodningen så att de inte kostar CPU och minne.
+
+Gmail API har redan tagit bort Content-Transfer-Encoding (quoted-printable,
+base64) i body.data - här återstår bara base64url-lagret och teckenkodningen.
+"""
+
+import base64
+import html
+
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024
+
+
+def extract_body(payload, max_bytes=DEFAULT_MAX_BYTES):
+    """Extrahera (html, text) från en Gmail-payload - tom sträng om delen saknas"""
+    html_body = None
+    text_body = None
+
+    # Stack istället för rekursion - delarna läggs i omvänd ordning för att
+    # behålla dokumentordningen
+    stack = [payload]
+    while stack and (html_body is None or text_body is None):
+        part = stack.pop()
+
+        if part.get('parts'):
+            stack.extend(reversed(part['parts']))
+            continue
+
+        if _is_attachment(part):
+            continue
+
+        mime_type = part.get('mimeType', '').lower()
+        if mime_type == 'text/html' and html_body is None:
+            html_body = _decode_part(part, max_bytes)
+        elif mime_type == 'text/plain' and text_body is None:
+            text_body = _decode_part(part, max_bytes)
+
+    return html_body or "", text_body or ""
+
+
+def text_as_html(text):
+    """Gör om en text/plain-body till enkel HTML (fallback när HTML-del saknas)"""
+    if not text:
+        return ""
+    return f'<pre style="white-space: pre-wrap; font-family: sans-serif;">{html.escape(text)}</pre>'
+
+
+def _is_attachment(part):
+    """Bilagor och inline-bilder har filnamn, attachmentId eller disposition"""
+    if part.get('filename'):
+        return True
+    if 'attachmentId' in part.get('body', {}):
+        return True
+    disposition = _header(part, 'Content-Disposition').lower()
+    return disposition.startswith('attachment')
+
+
+def _decode_part(part, max_bytes):
+    """Avkoda body.data med deklarerad charset, högst max_bytes"""
+    data = part.get('body', {}).get('data')
+    if not data:
+        return None
+
+    # 4 base64-tecken blir 3 bytes - skär av innan avkodning
+    limit = ((max_bytes + 2) // 3) * 4
+    truncated = len(data) > limit
+    data = data[:limit]
+    raw = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))[:max_bytes]
+
+    if truncated:
+        print(f"Body större än {max_bytes} bytes - skärs av")
+
+    charset = _charset(part)
+    try:
+        return raw.decode(charset, errors='replace')
+    except LookupError:
+        return raw.decode('utf-8', errors='replace')
+
+
+def _charset(part):
+    """Läs charset från Content-Type, default utf-8"""
+    content_type = _header(part, 'Content-Type')
+    for param in content_type.split(';')[1:]:
+        key, _, value = param.strip().partition('=')
+        if key.lower() == 'charset' and value:
+            return value.strip('"\' ').lower()
+    return 'utf-8'
+
+
+def _header(part, name):
+    name = name.lower()
+    return next((h['value'] for h in part.get('headers', []) if h['name'].lower() == name), '')
@@ -0,0 +1,103 @@
+"""Prompt-packning - fyller en tokenbudget med block i prioritetsordning
+
+Varje block har en rubrik som alltid tas med och en brödtext som kan kortas.
+Packningen sker i två steg:
+
+1. I prioritetsordning får varje block sin rubrik och en minsta brödtext.
+   Block som inte ryms ens så utelämnas (lägst prioritet först).
+2. Resterande budget fördelas jämnt mellan brödtexterna, prioritetsnivå för
+   prioritetsnivå - långa texter kortas istället för att hela block försvinner.
+
+Tokens uppskattas från antal tecken (tokenizern finns inte lokalt). Uppskattningen
+är medvetet försiktig så att budgeten hellre underskrids än överskrids.
+"""
+
+import math
+
+# Försiktigt snitt för svensk/engelsk text med emojis och länkar
+CHARS_PER_TOKEN = 3
+
+TRUNCATION_MARK = '…'
+
+
+def estimate_tokens(text):
+    """Uppskatta antal tokens i en text"""
+    return math.ceil(len(text) / CHARS_PER_TOKEN) if text else 0
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Korta en text till max_tokens, helst vid ett ordslut"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    max_chars = max(0, max_tokens * CHARS_PER_TOKEN - len(TRUNCATION_MARK))
+    cut = text[:max_chars]
+    space = cut.rfind(' ')
+    if space > max_chars * 0.8:
+        cut = cut[:space]
+    return cut.rstrip() + TRUNCATION_MARK
+
+
+def pack_blocks(blocks, budget, min_body_tokens=40):
+    """Packa block inom budget tokens
+
+    blocks: lista med {'header': str, 'body': str, 'priority': int} - högre
+    prioritet packas först. Returnerar (texter, statistik) där texter har samma
+    ordning som blocks och är None för utelämnade block.
+    """
+    header_tokens = [estimate_tokens(block['header']) for block in blocks]
+    body_tokens = [estimate_tokens(block.get('body') or '') for block in blocks]
+    order = sorted(range(len(blocks)), key=lambda i: -blocks[i].get('priority', 0))
+
+    # Steg 1: rubrik + minsta brödtext, i prioritetsordning
+    remaining = budget
+    allowance = {}
+    for i in order:
+        minimum = header_tokens[i] + min(body_tokens[i], min_body_tokens)
+        if minimum > remaining:
+            continue
+        allowance[i] = min(body_tokens[i], min_body_tokens)
+        remaining -= minimum
+
+    # Steg 2: fördela resten jämnt, en prioritetsnivå i taget
+    for priority in sorted({blocks[i].get('priority', 0) for i in allowance}, reverse=True):
+        tier = [i for i in allowance if blocks[i].get('priority', 0) == priority]
+        extra = {i: body_tokens[i] - allowance[i] for i in tier}
+        cap = _water_level(list(extra.values()), remaining)
+        for i in tier:
+            granted = min(extra[i], cap)
+            allowance[i] += granted
+            remaining -= granted
+
+    texts = []
+    stats = {'tokens': 0, 'budget': budget, 'blocks': len(allowance), 'truncated': 0, 'dropped': 0}
+    for i, block in enumerate(blocks):
+        if i not in allowance:
+            texts.append(None)
+            stats['dropped'] += 1
+            continue
+        body = block.get('body') or ''
+        if allowance[i] < body_tokens[i]:
+            # Behåll avslutande radbrytning så att nästa block börjar på egen rad
+            ending = '\n' if body.endswith('\n') else ''
+            body = truncate_to_tokens(body, allowance[i]) + ending
+            stats['truncated'] += 1
+        text = block['header'] + body
+        stats['tokens'] += estimate_tokens(text)
+        texts.append(text)
+
+    return texts, stats
+
+
+def _water_level(needs, available):
+    """Största tak c så att sum(min(need, c)) ryms i available"""
+    if sum(needs) <= available:
+        return max(needs, default=0)
+
+    needs = sorted(needs)
+    for index, need in enumerate(needs):
+        # Alla återstående får minst need - ryms det inte sätts taket här
+        remaining_count = len(needs) - index
+        if need * remaining_count > available:
+            return available // remaining_count
+        available -= need
+    return 0
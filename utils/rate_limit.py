@@ -0,0 +1,61 @@
+"""Token bucket - begränsar takten för anrop och tokens per minut
+
+Hinken fylls på kontinuerligt med rate_per_minute / 60 per sekund upp till
+rate_per_minute. acquire() väntar tills det finns tillräckligt, och adjust()
+rättar i efterhand när den verkliga förbrukningen är känd (saldot kan då bli
+negativt, vilket bromsar kommande anrop).
+"""
+
+import threading
+import time
+
+
+class TokenBucket:
+    def __init__(self, rate_per_minute):
+        self.capacity = rate_per_minute
+        self.rate = rate_per_minute / 60
+        self.tokens = rate_per_minute
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.capacity > 0
+
+    def acquire(self, amount=1, deadline=None):
+        """Ta amount ur hinken, vänta vid behov - returnerar väntetiden i sekunder
+
+        Större uttag än hinkens kapacitet väntar bara tills hinken är full (och
+        överskottet tas inte ut) - anroparen bör varna för sådana uttag. Om väntan
+        skulle passera deadline (time.monotonic()) kastas TimeoutError.
+        """
+        if not self.enabled:
+            return 0.0
+
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+                wait = (amount - self.tokens) / self.rate
+
+            if deadline is not None and time.monotonic() + wait > deadline:
+                raise TimeoutError(f"Rate limit: väntan på {wait:.1f}s skulle passera deadline")
+            time.sleep(wait)
+            waited += wait
+
+    def adjust(self, delta):
+        """Lägg tillbaka (positivt) eller dra av (negativt) i efterhand"""
+        if not self.enabled:
+            return
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + delta)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
@@ -0,0 +1,48 @@
+"""Lokal svarscache - sparar Claude-svar på disk med begränsad livslängd
+
+Nyckeln är en hash av modell, parametrar och prompt, så en identisk omkörning
+av samma vecka får svaret direkt utan API-anrop. Poster äldre än ttl räknas
+som saknade, och cachen rensas enligt LRU när den blir större än max_bytes.
+"""
+
+import hashlib
+import json
+import time
+import zlib
+
+from utils.disk_cache import DiskCache
+
+
+def request_key(**request):
+    """Stabil nyckel för ett anrop - samma modell, parametrar och prompt ger samma nyckel"""
+    payload = json.dumps(request, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache(DiskCache):
+    def __init__(self, path, max_bytes=50 * 1024 * 1024, ttl=7 * 24 * 3600):
+        super().__init__(path, max_bytes)
+        self.ttl = ttl
+
+    def get(self, key):
+        """Hämta ett cachat svar, eller None om det saknas eller är för gammalt"""
+        blob = super().get(key)
+        if blob is None:
+            return None
+        try:
+            entry = json.loads(zlib.decompress(blob))
+        except Exception as e:
+            print(f"Trasig post i svarscachen: {e}")
+            self.delete(key)
+            return None
+
+        if time.time() - entry['created'] > self.ttl:
+            self.delete(key)
+            return None
+        return entry['data']
+
+    def put(self, key, data):
+        """Spara ett svar tillsammans med när det skapades"""
+        entry = {'created': time.time(), 'data': data}
+        blob = zlib.compress(json.dumps(entry, ensure_ascii=False).encode('utf-8'))
+        super().put(key, blob)
@@ -0,0 +1,139 @@
+"""Videourval - väljer YouTube-videos som passar veckans innehåll
+
+Varje video får en vikt av två delar:
+
+- ålder: nyare videos föredras (samma nivåer som tidigare)
+- relevans: cosinuslikhet mellan videons TF-IDF-vektor (titel, kategori,
+  beskrivning) och veckans newsletter-text
+
+Vikter och vektorer räknas fram en gång per videobibliotek och återanvänds.
+Urvalet görs utan återläggning med Efraimidis-Spirakis (nyckel u^(1/w), de k
+största behålls i en heap) - O(n log k) och seedbart för reproducerbarhet.
+"""
+
+import heapq
+import math
+import random
+import re
+from datetime import date, datetime
+
+WORD_RE = re.compile(r'[^\W\d_]{3,}')
+
+STOPWORDS = {
+    'and', 'the', 'for', 'with', 'this', 'that', 'from', 'you', 'your', 'are', 'how', 'what', 'new',
+    'och', 'att', 'det', 'som', 'för', 'med', 'den', 'har', 'inte', 'till', 'från', 'hur', 'vad', 'kan',
+}
+
+# Även videos utan ordöverlapp med veckan ska kunna väljas ibland
+RELEVANCE_FLOOR = 0.2
+
+# Videobiblioteket ändras sällan - index per bibliotek återanvänds mellan körningar
+_INDEX_CACHE = {}
+
+
+def age_weight(published_date, today):
+    """Vikt baserat på ålder"""
+    if not published_date:
+        return 0.3  # Default medel-sannolikhet om datum saknas
+
+    try:
+        if isinstance(published_date, str):
+            pub_date = datetime.strptime(published_date, '%Y-%m-%d').date()
+        else:
+            pub_date = published_date
+        days_old = (today - pub_date).days
+    except (TypeError, ValueError):
+        return 0.3
+
+    if days_old < 30:  # <1 månad
+        return 0.8
+    elif days_old < 90:  # 1-3 månader
+        return 0.5
+    elif days_old < 180:  # 3-6 månader
+        return 0.3
+    else:  # >6 månader
+        return 0.1
+
+
+def tokenize(text):
+    return [word for word in WORD_RE.findall(text.lower()) if word not in STOPWORDS]
+
+
+class VideoIndex:
+    """Förberäknade åldersvikter och TF-IDF-vektorer för ett videobibliotek"""
+
+    def __init__(self, videos, today=None):
+        today = today or date.today()
+        self.videos = videos
+        self.age_weights = [age_weight(video.get('published_date'), today) for video in videos]
+
+        documents = [
+            tokenize(f"{video.get('title') or ''} {video.get('category') or ''} {video.get('description') or ''}")
+            for video in videos
+        ]
+        document_frequency = {}
+        for words in documents:
+            for word in set(words):
+                document_frequency[word] = document_frequency.get(word, 0) + 1
+
+        count = len(videos)
+        self.idf = {word: math.log((1 + count) / (1 + df)) + 1 for word, df in document_frequency.items()}
+
+        # Inverterat index: ord -> [(video, normaliserad vikt)]
+        self.postings = {}
+        for i, words in enumerate(documents):
+            for word, weight in _normalized_tfidf(words, self.idf).items():
+                self.postings.setdefault(word, []).append((i, weight))
+
+    def relevance(self, text):
+        """Cosinuslikhet mellan texten och varje video"""
+        scores = [0.0] * len(self.videos)
+        for word, query_weight in _normalized_tfidf(tokenize(text), self.idf).items():
+            for i, weight in self.postings.get(word, ()):
+                scores[i] += query_weight * weight
+        return scores
+
+    def select(self, text, count, seed=None):
+        """Välj count videos viktat på ålder och relevans, utan återläggning"""
+        if not self.videos or count <= 0:
+            return []
+
+        rng = random.Random(seed)
+        keyed = []
+        for i, relevance in enumerate(self.relevance(text)):
+            weight = self.age_weights[i] * (RELEVANCE_FLOOR + relevance)
+            # log(u)/w ger samma ordning som u^(1/w) utan underflow för små vikter
+            key = math.log(1.0 - rng.random()) / weight if weight > 0 else -math.inf
+            keyed.append((key, i))
+
+        return [self.videos[i] for _, i in heapq.nlargest(count, keyed)]
+
+
+def get_index(videos, today=None):
+    """Index för biblioteket - byggs om bara när videorna ändrats"""
+    today = today or date.today()
+    key = (today, tuple(
+        (video.get('id'), video.get('title'), video.get('category'),
+         video.get('description'), video.get('published_date'))
+        for video in videos
+    ))
+    index = _INDEX_CACHE.get(key)
+    if index is None:
+        # Bara senaste biblioteket behöver sparas
+        _INDEX_CACHE.clear()
+        index = _INDEX_CACHE[key] = VideoIndex(videos, today)
+    return index
+
+
+def _normalized_tfidf(words, idf):
+    """TF-IDF-vektor (dict) med längd 1 - okända ord ignoreras"""
+    counts = {}
+    for word in words:
+        if word in idf:
+            counts[word] = counts.get(word, 0) + 1
+
+    vector = {word: (1 + math.log(tf)) * idf[word] for word, tf in counts.items()}
+    norm = math.sqrt(sum(value * value for value in vector.values()))
+    if not norm:
+        return {}
+    return {word: value / norm for word, value in vector.items()}